@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import test
+from interpreter.decode      import decode
+from interpreter.encode      import encode, encode_with, usable_cpus
+from interpreter.interpreter import (
+    interpret,
+    MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV,
+)
+from interpreter.optimize    import optimize
+from interpreter.vm          import Machine, assemble
+
+# ------------------------ Programs ------------------------
+
+ARG_COMMANDS = [MOVE, CADD, COPY, SET, MUL, DIV, ADD, SUB, SWAP, CMUL, CDIV]
+
+def generate_program(size: int, depth: int = 0, seed: int = 0) -> list:
+    # `size` instructions with small arguments, wrapped in `depth` nested LOOPs
+    rng = random.Random(seed)
+    program = []
+    for _ in range(size):
+        r = rng.random()
+        if   r < 0.05: program.append(IN())
+        elif r < 0.10: program.append(OUT())
+        else:          program.append(rng.choice(ARG_COMMANDS)(rng.randint(-8, 8)))
+
+    for _ in range(depth):
+        program = [MOVE(1), LOOP(program + [CADD(-1)])]
+    return program
+
+def generate_runnable(size: int, seed: int = 0) -> list:
+    # `size` straight-line instructions that always run to the end: no
+    # division, and cells only grow by adding
+    rng = random.Random(seed)
+    commands = [MOVE, CADD, COPY, SET, ADD, SUB, SWAP]
+    program = []
+    for _ in range(size):
+        cls = rng.choice(commands)
+        if   rng.random() < 0.05: program.append(OUT())
+        elif cls is MOVE:         program.append(MOVE(rng.choice([-1, 1])))
+        else:                     program.append(cls(rng.randint(-3, 3)))
+    return program
+
+def nested_program_int(size: int, depth: int) -> int:
+    # generate_program(size, depth) needs recursion to encode; for deep nesting
+    # build the extended-alphabet bits directly: `depth` LOOP codes, then the
+    # body (unterminated blocks are closed at the end of the program)
+    n = encode_with(generate_program(size), "normal", False, 1)
+    body = n.bit_length() - 7
+    loops = 0b01100 * ((1 << 5 * depth) - 1) // 31    # 01100 repeated
+    return ((n >> body) << (5 * depth + body)) | (loops << body) | (n & ((1 << body) - 1))
+
+def fibonacci(n: int) -> int:
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+# test.py programs with inputs at increasing scales (quick runs use the first)
+SCALED = {
+    "FACTORIAL":     [test.lines(n) for n in (100, 1_000, 5_000)],
+    "SQRT":          [test.lines(n * n) for n in (1_000, 10_000, 100_000)],
+    "FIBONACCI":     [test.lines(n) for n in (1_000, 10_000, 100_000)],
+    "GCD":           [test.lines(fibonacci(n + 1), fibonacci(n)) for n in (100, 1_000, 10_000)],
+    "POWER":         [test.lines(3, n) for n in (100, 1_000, 10_000)],
+    "TRIANGULAR":    [test.lines(10 ** 100)],
+    "COLLATZ":       [test.lines(n) for n in (27, 837_799, 63_728_127)],
+    "TRUTH_MACHINE": [test.lines(0)],
+}
+
+# ------------------------ Measurement ------------------------
+
+def timed(f, *args) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+def measure(f, *args, repeat: int = 1, memory: bool = True) -> tuple[float, int | None, object]:
+    # (best wall time of `repeat` runs, peak traced allocation, result);
+    # memory is traced in one extra run, tracing slows everything down
+    best = float("inf")
+    for _ in range(repeat):
+        seconds, result = timed(f, *args)
+        best = min(best, seconds)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        f(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak, result
+
+def steps(program: list, input: bytes) -> int:
+    # instructions executed, counted by the VM (a LOOP test counts as one)
+    machine = Machine(assemble(program), input)
+    machine.run()
+    return machine.steps
+
+class Suite:
+    def __init__(self, memory: bool = True) -> None:
+        self.memory = memory
+        self.results = []
+
+    def record(self, group: str, name: str, f, *args, repeat: int = 1,
+               instructions: int | None = None, bits: int | None = None, **fields) -> object:
+        seconds, peak, result = measure(f, *args, repeat=repeat, memory=self.memory)
+        record = {"group": group, "name": name, **fields, "seconds": seconds,
+                  "instructions": instructions, "peak_bytes": peak, "bits": bits}
+        record["instructions_per_second"] = instructions / seconds if instructions and seconds else None
+        self.results.append(record)
+
+        rate = f"{record['instructions_per_second'] / 1e6:8.2f}M/s" if record["instructions_per_second"] else " " * 10
+        memory = f"{peak / 1e6:9.1f}MB" if peak is not None else ""
+        extra = " ".join(f"{k}={v}" for k, v in fields.items())
+        print(f"  {group:<10} {name:<14} {extra:<30} {seconds * 1e3:11.3f}ms {rate} {memory}", flush=True)
+        return result
+
+# ------------------------ Benchmarks ------------------------
+
+def bench_encode(suite: Suite, quick: bool) -> None:
+    sizes = [(1_000, 0), (10_000, 0), (1_000, 500)] + ([] if quick else [(100_000, 0), (1_000_000, 0)])
+    for name in SCALED:
+        program = getattr(test, name)
+        n = suite.record("encode", name, encode, program, repeat=100)
+        suite.results[-1]["bits"] = n.bit_length()
+    for size, depth in sizes:
+        program = generate_program(size, depth)
+        n = suite.record("encode", "generated", encode, program, size=size, depth=depth, instructions=size)
+        suite.results[-1]["bits"] = n.bit_length()
+    # encode(workers=) against the serial runs above; it falls back to
+    # serial with fewer than MIN_WORKERS usable CPUs
+    for size in [] if quick else [100_000, 1_000_000]:
+        program = generate_program(size)
+        suite.record("encode", "workers", encode, program, usable_cpus(), size=size, workers=usable_cpus(),
+                     instructions=size)
+
+def bench_decode(suite: Suite, quick: bool) -> None:
+    sizes = [(1_000, 0), (10_000, 0), (1_000, 10_000)] + ([] if quick else [(100_000, 0), (1_000_000, 0)])
+    for name in SCALED:
+        n = encode(getattr(test, name))
+        suite.record("decode", name, decode, n, repeat=100, bits=n.bit_length())
+    for size, depth in sizes:
+        n = nested_program_int(size, depth)
+        suite.record("decode", "generated", decode, n, size=size, depth=depth,
+                     instructions=size + depth, bits=n.bit_length())
+
+def bench_interpret(suite: Suite, quick: bool) -> None:
+    # every engine on the program as written, and the VM and native
+    # engines on the optimized program
+    variants = [("tree", False), ("vm", False), ("native", False), ("vm", True), ("native", True)]
+    for name, inputs in SCALED.items():
+        program = getattr(test, name)
+        for scale, input in enumerate(inputs[:1] if quick else inputs):
+            count = steps(program, input)
+            for engine, optimized in variants:
+                code = optimize(program) if optimized else program
+                suite.record("interpret", name, interpret, code, input, engine, repeat=3,
+                             engine=engine + ("+opt" if optimized else ""), scale=scale, instructions=count)
+
+    sizes = [1_000, 10_000] + ([] if quick else [100_000, 1_000_000])
+    for size in sizes:
+        program = generate_runnable(size)
+        for engine, optimized in variants:
+            if engine == "native" and size > 100_000:
+                continue    # a million-line function takes longer to compile than to run
+            code = optimize(program) if optimized else program
+            suite.record("interpret", "generated", interpret, code, b"", engine, repeat=3,
+                         engine=engine + ("+opt" if optimized else ""), size=size, instructions=size)
+
+# ------------------------ Results ------------------------
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": sys.version.split()[0], "platform": platform.platform(), "cpus": usable_cpus(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def key(record: dict) -> tuple:
+    return tuple(sorted((k, v) for k, v in record.items()
+                        if k not in ("seconds", "instructions", "instructions_per_second", "peak_bytes", "bits")))
+
+def compare(old: dict, new: dict) -> None:
+    # time ratio new/old for every benchmark in both runs
+    before = {key(r): r for r in old["results"]}
+    print("-" * 80)
+    print(f"compared to {old['metadata'].get('commit')} ({old['metadata'].get('time')})")
+    for record in new["results"]:
+        previous = before.get(key(record))
+        if previous is None or not previous["seconds"]:
+            continue
+        ratio = record["seconds"] / previous["seconds"]
+        extra = " ".join(f"{k}={v}" for k, v in key(record) if k not in ("group", "name"))
+        flag = "  slower" if ratio > 1.1 else "  faster" if ratio < 0.9 else ""
+        print(f"  {record['group']:<10} {record['name']:<14} {extra:<38} {ratio:6.2f}x{flag}")
+    print("-" * 80)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark encode, decode and interpret.")
+    parser.add_argument("--quick", action="store_true", help="small sizes and inputs only")
+    parser.add_argument("--only", default="encode,decode,interpret", help="comma-separated groups to run")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    parser.add_argument("--output", default="bench_output.json", help="where to write the results (JSON)")
+    parser.add_argument("--compare", default=None, help="earlier results to compare against")
+    args = parser.parse_args()
+    sys.set_int_max_str_digits(0)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10_000))
+
+    suite = Suite(memory=not args.no_memory)
+    groups = {"encode": bench_encode, "decode": bench_decode, "interpret": bench_interpret}
+    print("-" * 80)
+    for group in args.only.split(","):
+        groups[group](suite, args.quick)
+    print("-" * 80)
+
+    results = {"metadata": metadata(), "results": suite.results}
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import asyncio
+import inspect
+import time
+from collections import deque
+from typing import BinaryIO
+from interpreter.interpreter import InputPending
+from interpreter.vm import Bytecode, Machine, assemble, INPUT, OUTPUT, STEPS
+
+# ------------------------ Input ------------------------
+
+class StreamInput:
+    # IN's lines from an asyncio stream (anything with an async readline(),
+    # such as asyncio.StreamReader). The Machine reads it like a file
+    # through InputReader; a line that hasn't arrived yet raises
+    # InputPending, and the session awaits fill() before running the IN again
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.lines = deque()
+        self.eof = False
+
+    def readline(self) -> bytes:
+        if self.lines: return self.lines.popleft()
+        if self.eof:   return b""
+        raise InputPending
+
+    async def fill(self) -> None:
+        line = await self.stream.readline()
+        if line: self.lines.append(line)
+        else:    self.eof = True
+
+def is_stream(input) -> bool:
+    return inspect.iscoroutinefunction(getattr(input, "readline", None))
+
+# ------------------------ Output ------------------------
+# sink: a writer with write() (and drain(), like asyncio.StreamWriter),
+# or a callable taking bytes, which may return an awaitable
+
+async def write(sink, chunk: bytes) -> None:
+    if hasattr(sink, "write"):
+        sink.write(chunk)
+        if hasattr(sink, "drain"):
+            await sink.drain()
+    else:
+        result = sink(chunk)
+        if inspect.isawaitable(result):
+            await result
+
+# ------------------------ Sessions ------------------------
+# A session runs a Machine a slice of instructions at a time, handing
+# control back to the event loop between slices and while IN waits for
+# a line, so thousands of sessions can share one thread and a long LOOP
+# in one of them doesn't starve the rest. Output waiting when a slice
+# ends (or at least buffer_size bytes of it) is written to the sink.
+
+SLICE = 10_000      # instructions between yields to the event loop
+
+async def execute(sink, code: Bytecode, input: bytes | BinaryIO = b"", slice: int = SLICE,
+                  max_steps: int | None = None, timeout: float | None = None, max_cell_bits: int | None = None,
+                  buffer_size: int | None = 1 << 16, arithmetic: str = "int") -> str:
+    # runs until the program halts or a budget is used up (the budgets of
+    # Machine.run, for the whole session; timeout counts time spent running,
+    # not waiting) and returns the Machine.run status. input: as for
+    # Machine, an asyncio stream, or a StreamInput
+    if is_stream(input):
+        input = StreamInput(input)
+    machine = Machine(code, input, arithmetic=arithmetic)
+    quantum = 0         # instructions since the last yield
+    spent = 0.0         # seconds running
+    while True:
+        steps = slice - quantum
+        if max_steps is not None:
+            steps = min(steps, max_steps - machine.steps)
+        before, start = machine.steps, time.monotonic()
+        status = machine.run(steps, None if timeout is None else timeout - spent, max_cell_bits, buffer_size)
+        quantum += machine.steps - before
+        spent += time.monotonic() - start
+
+        if machine.out:
+            await write(sink, machine.take_output())
+        if status == INPUT:
+            await input.fill()
+            quantum = 0
+        elif status == OUTPUT or status == STEPS and (max_steps is None or machine.steps < max_steps):
+            if quantum >= slice:
+                await asyncio.sleep(0)
+                quantum = 0
+        else:
+            return status
+
+async def interpret_async(program: list, input: bytes | BinaryIO = b"", slice: int = SLICE,
+                          arithmetic: str = "int") -> bytes:
+    # interpret() (with the vm engine) as a coroutine
+    out = bytearray()
+    await execute(out.extend, assemble(program), input, slice, arithmetic=arithmetic)
+    return bytes(out)
@@ -0,0 +1,132 @@
+from __future__ import annotations
+from interpreter.interpreter import (
+    MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, COUNTDOWN, AT, MEMO
+)
+
+# ------------------------ Pointer analysis ------------------------
+
+def inner(ins) -> list | None:
+    # the block a LOOP/IFZ/COUNTDOWN/MEMO runs, None for other instructions
+    if isinstance(ins, COUNTDOWN): return ins.loop.body
+    if isinstance(ins, MEMO):      return [ins.block]
+    return getattr(ins, "body", None)
+
+def reach(ins) -> tuple[int, int]:
+    # lowest and highest cell, relative to the pointer, one instruction touches
+    cls = type(ins)
+    if cls is MOVE:
+        return 0, 0
+    if cls in (COPY, SWAP, ADD, SUB, MUL, DIV):
+        return min(0, ins.k), max(0, ins.k)
+    if cls is AT:
+        a, b = reach(ins.ins)
+        return ins.offset + a, ins.offset + b
+    if cls is COUNTDOWN:
+        offsets = [0]
+        for offset, _, cells, _ in ins.adds + ins.muls:
+            offsets.append(offset)
+            offsets.extend(src for src, _ in cells)
+        return min(offsets), max(offsets)
+    return 0, 0
+
+
+# Both walk nested blocks with an explicit stack instead of recursion, so
+# nesting depth isn't limited by Python's recursion limit (as in decode).
+
+def extent(program: list) -> tuple[int, int]:
+    # lowest and highest offset any instruction in the program reaches from the pointer
+    lo = hi = 0
+    blocks = [program]
+    while blocks:
+        for ins in blocks.pop():
+            a, b = reach(ins)
+            lo, hi = min(lo, a), max(hi, b)
+            body = inner(ins)
+            if body is not None:
+                blocks.append(body)
+    return lo, hi
+
+
+def cell_range(program: list) -> tuple[int, int] | None:
+    # the window of cells (relative to the start) the program can touch,
+    # or None when it isn't statically bounded: a LOOP/IFZ body that
+    # doesn't return the pointer to where it started can walk anywhere
+    lo = hi = 0
+    block, p, start = iter(program), 0, 0
+    stack = []      # (rest of the enclosing block, its start) for every open body
+
+    while True:
+        for ins in block:
+            if isinstance(ins, MOVE):
+                p += ins.k
+                continue
+
+            a, b = reach(ins)
+            lo, hi = min(lo, p + a), max(hi, p + b)
+
+            body = inner(ins)
+            if body is not None:
+                stack.append((block, start))
+                block, start = iter(body), p
+                break
+        else:
+            if not stack:
+                return lo, hi
+            if p != start:
+                return None
+            block, start = stack.pop()
+
+# ------------------------ Effect analysis ------------------------
+
+def touches(ins) -> tuple[tuple, tuple]:
+    # (cells read, cells written), relative to the pointer, by one
+    # instruction that isn't a block, MOVE, IN or OUT
+    cls = type(ins)
+    if cls is AT:
+        reads, writes = touches(ins.ins)
+        return tuple(ins.offset + c for c in reads), tuple(ins.offset + c for c in writes)
+    if cls is COPY:                          return (0,), (ins.k,)
+    if cls is SWAP:                          return (0, ins.k), (0, ins.k)
+    if cls in (ADD, SUB, MUL, DIV):          return (0, ins.k), (0,)
+    if cls is SET:                           return (), (0,)
+    return (0,), (0,)
+
+
+def effect(ins) -> tuple[tuple, tuple] | None:
+    # (cells read, cells written), relative to the pointer, of a LOOP/IFZ
+    # whose result depends on nothing else: no IN/OUT, and every body in it
+    # leaves the pointer where it found it, so each instruction works on
+    # cells at fixed offsets. None for anything else. A cell that's
+    # written before it's read still counts as read: whether it's written
+    # at all can depend on the path taken.
+    if not isinstance(ins, (LOOP, IFZ)) or cell_range([ins]) is None:
+        return None
+    reads, writes = set(), set()
+
+    def walk(block: list, p: int) -> bool:
+        for ins in block:
+            cls = type(ins)
+            if cls is MOVE:
+                p += ins.k
+            elif cls is IN or cls is OUT or cls is AT and type(ins.ins) in (IN, OUT):
+                return False
+            elif cls is LOOP or cls is IFZ:
+                reads.add(p)
+                if not walk(ins.body, p): return False
+            elif cls is MEMO:
+                if not walk([ins.block], p): return False
+            elif cls is COUNTDOWN:
+                for offset, _, cells, _ in ins.adds + ins.muls:
+                    reads.update([p + offset] + [p + src for src, _ in cells])
+                    writes.add(p + offset)
+                if not walk([ins.loop], p): return False
+            else:
+                r, w = touches(ins)
+                reads.update(p + c for c in r + w)
+                writes.update(p + c for c in w)
+        return True
+
+    if not walk([ins], 0):
+        return None
+    return tuple(sorted(reads)), tuple(sorted(writes))
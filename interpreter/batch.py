@@ -0,0 +1,153 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import islice
+from interpreter.cache import ProgramCache
+from interpreter.vm import Bytecode, Machine
+
+# ------------------------ Jobs ------------------------
+
+@dataclass
+class Job:
+    program: int
+    input: bytes = b""
+    max_steps: int | None = None        # budgets for Machine.run, None: unlimited
+    timeout: float | None = None
+    max_cell_bits: int | None = None
+
+@dataclass
+class Result:
+    index: int          # position of the job in the batch
+    status: str         # why the machine stopped (vm.HALTED, ...), or ERROR
+    output: bytes
+    steps: int
+    error: str | None = None
+
+ERROR = "error"         # the program integer didn't decode, or the program raised
+
+# ------------------------ Worker ------------------------
+
+cache = ProgramCache()
+
+def prepared(program: int) -> Bytecode:
+    # decoded, optimized and assembled once per program integer per process
+    return cache.bytecode(program)
+
+def run_job(index: int, job: Job) -> Result:
+    try:
+        code = prepared(job.program)
+    except (ValueError, TypeError, RecursionError) as e:
+        return Result(index, ERROR, b"", 0, f"{type(e).__name__}: {e}")
+
+    machine = Machine(code, job.input)
+    try:
+        status = machine.run(job.max_steps, job.timeout, job.max_cell_bits)
+    except (ArithmeticError, MemoryError) as e:
+        return Result(index, ERROR, machine.take_output(), machine.steps, f"{type(e).__name__}: {e}")
+    return Result(index, status, machine.take_output(), machine.steps)
+
+def run_task(task: list) -> list:
+    # a task is a list of (index, job), grouped so each program is prepared once
+    return [run_job(index, job) for index, job in task]
+
+# ------------------------ Batch ------------------------
+
+def tasks(window: list, chunk_size: int) -> Iterator[list]:
+    # jobs of a window grouped by program, packed into tasks of about chunk_size jobs
+    by_program = {}
+    for index, job in window:
+        by_program.setdefault(job.program, []).append((index, job))
+    task = []
+    for group in by_program.values():
+        task.extend(group)
+        if len(task) >= chunk_size:
+            yield task
+            task = []
+    if task:
+        yield task
+
+def run_batch(jobs: Iterable, workers: int | None = None, ordered: bool = True,
+              window: int = 4096, chunk_size: int = 64) -> Iterator[Result]:
+    # jobs are Jobs or (program, input, ...) tuples, read lazily `window` at a
+    # time. Results come back in job order, or as they complete when
+    # ordered=False. workers=1 runs everything in this process.
+    jobs = ((i, job if isinstance(job, Job) else Job(*job)) for i, job in enumerate(jobs))
+
+    if workers == 1:
+        for index, job in jobs:
+            yield run_job(index, job)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    finished = {}       # index -> result waiting for the ones before it
+    next_index = 0
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        try:
+            while True:
+                batch = list(islice(jobs, window))
+                for task in tasks(batch, chunk_size):
+                    pending.add(pool.submit(run_task, task))
+
+                # keep a few tasks queued per worker; drain everything at the end
+                while pending and (not batch or len(pending) > 4 * workers):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for result in future.result():
+                            if not ordered: yield result
+                            else:           finished[result.index] = result
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+
+                if not batch:
+                    break
+        finally:
+            # the caller stopped early: don't start what's still queued
+            for future in pending:
+                future.cancel()
+
+# ------------------------ CLI ------------------------
+# one JSON job per line on stdin:
+#   {"program": <int or decimal string>, "input": "<hex>", "max_steps": ..., ...}
+# one JSON result per line on stdout, output as hex
+
+def parse_job(line: str, defaults: dict) -> Job:
+    job = json.loads(line)
+    return Job(
+        int(job["program"]),
+        bytes.fromhex(job.get("input", "")),
+        job.get("max_steps", defaults["max_steps"]),
+        job.get("timeout", defaults["timeout"]),
+        job.get("max_cell_bits", defaults["max_cell_bits"]),
+    )
+
+def main(argv: list | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m interpreter.batch",
+                                     description="Run IntScript jobs (JSON lines on stdin) in parallel.")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--unordered", action="store_true", help="print results as they complete")
+    parser.add_argument("--max-steps", type=int, default=None, help="default instruction budget per job")
+    parser.add_argument("--timeout", type=float, default=None, help="default seconds per job")
+    parser.add_argument("--max-cell-bits", type=int, default=None, help="default cell size cap per job")
+    args = parser.parse_args(argv)
+    sys.set_int_max_str_digits(0)   # program integers easily pass the default 4300 digits
+
+    defaults = {"max_steps": args.max_steps, "timeout": args.timeout, "max_cell_bits": args.max_cell_bits}
+    jobs = (parse_job(line, defaults) for line in sys.stdin if line.strip())
+    for result in run_batch(jobs, args.workers, not args.unordered):
+        record = {"index": result.index, "status": result.status,
+                  "output": result.output.hex(), "steps": result.steps}
+        if result.error is not None:
+            record["error"] = result.error
+        print(json.dumps(record), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from interpreter.interpreter import LOOP, IFZ, COUNTDOWN, MEMO, freeze
+
+# ------------------------ Forms ------------------------
+# what the cache can hold for a program integer, each built from the one before:
+#   "program"    decode(n), frozen (hashable, safe to share between callers)
+#   "optimized"  optimize(program)
+#   "bytecode"   vm.assemble(optimized)
+#   "native"     native.compile_program(optimized), never written to disk
+
+def build(cache: ProgramCache, n: int, form: str):
+    if form == "program":
+        from interpreter.decode import decode
+        return freeze(decode(n))
+    if form == "optimized":
+        from interpreter.optimize import optimize
+        return freeze(optimize(cache.get(n, "program")))
+    if form == "bytecode":
+        from interpreter.vm import assemble
+        return assemble(cache.get(n, "optimized"))
+    if form == "native":
+        from interpreter.native import compile_program
+        return compile_program(cache.get(n, "optimized"))
+    raise ValueError(f"Unknown form: {form}")
+
+DISK_FORMS = ("program", "optimized", "bytecode")
+DISK_VERSION = 2    # bumped whenever a stored form changes shape, so stale entries are rebuilt
+
+def instructions(program) -> int:
+    total = 0
+    for ins in program:
+        total += 1
+        if   isinstance(ins, (LOOP, IFZ)): total += instructions(ins.body)
+        elif isinstance(ins, COUNTDOWN):   total += instructions(ins.loop.body)
+        elif isinstance(ins, MEMO):        total += instructions([ins.block])
+    return total
+
+def footprint(n: int, form: str, value) -> int:
+    # rough bytes held by an entry: the key, plus an object per instruction
+    # (programs), five list slots per instruction (bytecode) or the
+    # generated function's code (native)
+    size = 64 + n.bit_length() // 8
+    if   form == "bytecode": size += 40 * len(value.ops)
+    elif form == "native":   size += 4 * len(value.__code__.co_code)
+    else:                    size += 64 * instructions(value)
+    return size
+
+# ------------------------ Cache ------------------------
+
+@dataclass
+class CacheStats:
+    hits: int = 0           # found in memory
+    disk_hits: int = 0      # found on disk (not counted as misses)
+    misses: int = 0         # built
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0          # estimated, see footprint()
+
+class ProgramCache:
+    # LRU cache of decoded/compiled programs keyed by (program integer, form),
+    # bounded by entry count and by estimated memory. With a directory,
+    # picklable forms are also stored there, so a restarted process loads
+    # them instead of decoding; only point it at a directory you trust,
+    # entries are unpickled.
+    def __init__(self, maxsize: int = 256, max_bytes: int | None = None, directory: str | None = None) -> None:
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()    # (n, form) -> (value, bytes)
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, n: int, form: str = "program"):
+        key = (n, form)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats.hits += 1
+                return entry[0]
+
+        # built outside the lock; two threads may build the same entry
+        value = self.load(n, form)
+        if value is None:
+            value = build(self, n, form)
+            self.store(n, form, value)
+            with self.lock: self.stats.misses += 1
+        else:
+            with self.lock: self.stats.disk_hits += 1
+        self.insert(key, value, footprint(n, form, value))
+        return value
+
+    def program(self, n: int) -> tuple:
+        return self.get(n, "program")
+
+    def bytecode(self, n: int):
+        return self.get(n, "bytecode")
+
+    def native(self, n: int):
+        return self.get(n, "native")
+
+    def insert(self, key: tuple, value, size: int) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.stats.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.stats.bytes += size
+            while self.entries and (len(self.entries) > self.maxsize or
+                                    self.max_bytes is not None and self.stats.bytes > self.max_bytes):
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.stats.bytes -= evicted
+                self.stats.evictions += 1
+            self.stats.entries = len(self.entries)
+
+    def clear(self) -> None:
+        # memory only; the disk tier is kept
+        with self.lock:
+            self.entries.clear()
+            self.stats.entries = self.stats.bytes = 0
+
+    # ------------------------ Disk tier ------------------------
+
+    def path(self, n: int, form: str) -> str:
+        digest = hashlib.sha256(n.to_bytes((n.bit_length() + 8) // 8, "big", signed=True)).hexdigest()
+        return os.path.join(self.directory, f"{digest}.{form}.v{DISK_VERSION}.pickle")
+
+    def load(self, n: int, form: str):
+        if self.directory is None or form not in DISK_FORMS:
+            return None
+        try:
+            with open(self.path(n, form), "rb") as f:
+                stored_n, value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError, RecursionError):
+            return None     # missing, or unreadable: rebuild it
+        return value if stored_n == n else None
+
+    def store(self, n: int, form: str, value) -> None:
+        if self.directory is None or form not in DISK_FORMS:
+            return
+        # written to a temporary file and renamed, so readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((n, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(n, form))
+        except (OSError, pickle.PicklingError, RecursionError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
@@ -0,0 +1,200 @@
+from __future__ import annotations
+import argparse
+import decimal
+import mmap
+import os
+import struct
+import sys
+import zlib
+from typing import BinaryIO
+from interpreter.decode import BitReader, LazyBlock, Source, decode_table, header
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# ------------------------ Format ------------------------
+# A program integer as a file, without going through decimal:
+#
+#   offset  size
+#   0       4     magic b"ISPG"
+#   4       1     version
+#   5       1     flags (bit 0: the checksum is set)
+#   6       2     zero
+#   8       8     bit length of the integer
+#   16      4     CRC-32 of the payload (0 without the checksum flag)
+#   20      4     zero
+#   24      ...   payload: the integer, (bit length + 7) // 8 bytes, little-endian
+#
+# Integers are little-endian throughout. The payload starts at a fixed,
+# 8-byte aligned offset, so a memory-mapped file can be read in place.
+
+MAGIC = b"ISPG"
+VERSION = 1
+CHECKSUM = 1
+HEADER = struct.Struct("<4sBBxxQI4x")
+
+def dumps(n: int, checksum: bool = True) -> bytes:
+    if n < 0:
+        raise ValueError("program integers are not negative")
+    nbits = n.bit_length()
+    payload = n.to_bytes((nbits + 7) // 8, "little")
+    crc = zlib.crc32(payload) if checksum else 0
+    return HEADER.pack(MAGIC, VERSION, CHECKSUM if checksum else 0, nbits, crc) + payload
+
+def unpack(data) -> tuple[int, memoryview]:
+    # (bit length, payload) of a container in a buffer, checked
+    if len(data) < HEADER.size:
+        raise ValueError("not an IntScript container: too short")
+    magic, version, flags, nbits, crc = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not an IntScript container: bad magic")
+    if version != VERSION:
+        raise ValueError(f"Unsupported container version: {version}")
+
+    nbytes = (nbits + 7) // 8
+    if len(data) != HEADER.size + nbytes:
+        raise ValueError(f"container payload is {len(data) - HEADER.size} bytes, expected {nbytes}")
+    payload = memoryview(data)[HEADER.size:]
+    if nbytes and payload[-1].bit_length() != nbits - 8 * (nbytes - 1):
+        error = "container bit length doesn't match its payload"
+    elif flags & CHECKSUM and zlib.crc32(payload) != crc:
+        error = "container checksum mismatch"
+    else:
+        return nbits, payload
+    payload.release()   # or a mapped file can't be closed
+    raise ValueError(error)
+
+def loads(data) -> int:
+    # data: bytes, bytearray, mmap or anything else with the buffer protocol
+    _, payload = unpack(data)
+    with payload:
+        return int.from_bytes(payload, "little")
+
+def reader(data) -> BitReader:
+    # a BitReader over the container's integer, for decode_table, without
+    # building the integer: the payload reversed is its big-endian bytes
+    nbits, payload = unpack(data)
+    with payload:
+        return BitReader(bytes(payload[::-1]), nbits)
+
+# ------------------------ Files ------------------------
+# file: a path, or a binary file object. Paths are memory-mapped, so
+# loading reads the payload once, in place.
+
+def dump(n: int, file: str | os.PathLike | BinaryIO, checksum: bool = True) -> None:
+    data = dumps(n, checksum)
+    if hasattr(file, "write"):
+        file.write(data)
+    else:
+        with open(file, "wb") as f:
+            f.write(data)
+
+def mapped(file: str | os.PathLike | BinaryIO, f) -> object:
+    # f(buffer) on the file's contents
+    if hasattr(file, "read"):
+        return f(file.read())
+    with open(file, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return f(b"")       # can't map an empty file
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return f(m)
+
+def load(file: str | os.PathLike | BinaryIO) -> int:
+    return mapped(file, loads)
+
+def load_program(file: str | os.PathLike | BinaryIO, lazy: bool = False):
+    # the decoded program (decode_lazy's LazyBlock with lazy=True),
+    # straight from the payload bits
+    r = mapped(file, reader)
+    m, width, table = header(r)
+    if lazy:
+        return LazyBlock(Source(r, m, width, table), r.pos)
+    return decode_table(r, m, width, table)
+
+# ------------------------ Decimal ------------------------
+# int <-> str is quadratic in CPython (and refused past 4300 digits by
+# default). These split the number in halves recursively, so the work
+# is a few big multiplications: by powers of 10 parsing, and by powers of
+# 2 in the decimal module (whose multiplication is subquadratic)
+# printing. gmpy2, when installed, does both faster.
+
+DIGITS = 3000       # chunk size converted directly, under the 4300 digit limit
+BITS = 8000         # chunk size printed directly, about 2400 digits
+
+def from_decimal(s: str) -> int:
+    s = s.strip()
+    if not (s.isascii() and s.isdigit()):
+        raise ValueError("program integers are written as decimal digits")
+    if gmpy2 is not None:
+        return int(gmpy2.mpz(s))
+
+    powers = {}
+    def power10(k: int) -> int:
+        if k not in powers:
+            powers[k] = 10 ** k
+        return powers[k]
+
+    def convert(s: str) -> int:
+        if len(s) <= DIGITS:
+            return int(s)
+        k = len(s) // 2
+        return convert(s[:-k]) * power10(k) + convert(s[-k:])
+
+    return convert(s)
+
+def to_decimal(n: int) -> str:
+    if n < 0:
+        raise ValueError("program integers are not negative")
+    if gmpy2 is not None:
+        return gmpy2.mpz(n).digits(10)
+    if n.bit_length() <= BITS:
+        return str(n)
+
+    context = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX)
+    powers = {}
+    def power2(w: int) -> decimal.Decimal:
+        if w not in powers:
+            powers[w] = context.power(decimal.Decimal(2), w)
+        return powers[w]
+
+    def convert(n: int, w: int) -> decimal.Decimal:
+        # n < 2 ** w
+        if w <= BITS:
+            return decimal.Decimal(n)
+        half = w // 2
+        hi = n >> half
+        return context.add(context.multiply(convert(hi, w - half), power2(half)),
+                           convert(n - (hi << half), half))
+
+    return str(convert(n, n.bit_length()))
+
+# ------------------------ CLI ------------------------
+
+def main(argv: list | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m interpreter.container",
+                                     description="Convert a program integer between decimal text and a container file.")
+    parser.add_argument("source", help="decimal text or a container file ('-': decimal on stdin)")
+    parser.add_argument("dest", help="where to write the other form ('-': decimal on stdout)")
+    parser.add_argument("--no-checksum", action="store_true", help="don't store a payload checksum")
+    args = parser.parse_args(argv)
+
+    if args.source == "-":
+        n = from_decimal(sys.stdin.read())
+        dump(n, args.dest, not args.no_checksum)
+        return
+    with open(args.source, "rb") as f:
+        is_container = f.read(len(MAGIC)) == MAGIC
+    if not is_container:
+        with open(args.source) as f:
+            dump(from_decimal(f.read()), args.dest, not args.no_checksum)
+    elif args.dest == "-":
+        print(to_decimal(load(args.source)))
+    else:
+        with open(args.dest, "w") as f:
+            f.write(to_decimal(load(args.source)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
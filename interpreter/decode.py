@@ -1,24 +1,68 @@
 from __future__ import annotations
 import math
+from functools import lru_cache
 from interpreter.interpreter import (
     MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
-    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, Commands
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, Commands, SMALL, SMALL_ARGS, intern
 )
 
+# ------------------------ Bit reader ------------------------
+
+class BitReader:
+    # a cursor over the bits of a big-endian buffer, MSB first. Reads
+    # only touch the bytes they need, so nothing is copied per argument.
+    def __init__(self, data: bytes, nbits: int, pos: int = 0) -> None:
+        self.data = data
+        self.nbits = nbits
+        self.pad = len(data) * 8 - nbits   # unused high bits of the first byte
+        self.pos = pos
+
+    @classmethod
+    def from_int(cls, n: int) -> BitReader:
+        nbits = n.bit_length()
+        return cls(n.to_bytes((nbits + 7) // 8, "big"), nbits)
+
+    def at_end(self) -> bool:
+        return self.pos >= self.nbits
+
+    def read(self, nbits: int) -> int:
+        if self.pos + nbits > self.nbits:
+            raise ValueError("truncated program")
+        if nbits == 0:
+            return 0
+        start = self.pos + self.pad
+        end = start + nbits
+        chunk = int.from_bytes(self.data[start >> 3:(end + 7) >> 3], "big")
+        self.pos += nbits
+        return (chunk >> (-end & 7)) & ((1 << nbits) - 1)
+
+    def read_unary(self) -> int:
+        # number of 0s before the next 1, which is consumed
+        data = self.data
+        a = self.pos + self.pad
+        i = a >> 3
+        byte = data[i] & (0xFF >> (a & 7)) if i < len(data) else 0
+        while byte == 0:
+            i += 1
+            if i >= len(data):
+                raise ValueError("truncated program")
+            byte = data[i]
+        one = i * 8 + 8 - byte.bit_length()    # position of the 1
+        q = one - a
+        self.pos += q + 1
+        return q
+
+# ------------------------ Codes ------------------------
+
 def unsigned_to_signed(u: int) -> int:
     # ZigZag
     if (u % 2) == 0: return u // 2
     else:            return -(u + 1) // 2
 
-def golomb_decode(bits: str, m: int) -> tuple[int, int]:
+def golomb_decode(reader: BitReader, m: int) -> int:
 
     # read quotient
-    i = 0
-    q = 0
-    while bits[i] == "0":
-        q += 1
-        i += 1
-    i += 1  # read the '1'
+    q = reader.read_unary()
 
     # read remainder
     k = (m - 1).bit_length()
@@ -26,170 +70,316 @@ def golomb_decode(bits: str, m: int) -> tuple[int, int]:
 
     if k == 0:
         r = 0
+    elif reader.nbits - reader.pos < k:
+        # cut off by the end of the bits: read what's left as a shorter
+        # number, as the string decoder before this one did
+        left = reader.nbits - reader.pos
+        if left == 0:
+            raise ValueError("truncated program")
+        x = reader.read(left)
+        r = x if x < t else x - t
     else:
-        x_bits = k - 1
-        x = int(bits[i:i + x_bits], 2) if x_bits > 0 else 0
+        x = reader.read(k - 1)
         if x < t:
             r = x
-            i += x_bits
         else:
-            x = int(bits[i:i + k], 2)
-            r = x - t
-            i += k
+            r = ((x << 1) | reader.read(1)) - t
 
     # construct unsigned
     u = q * m + r
-    return unsigned_to_signed(u), i
+    return unsigned_to_signed(u)
 
+# small arguments are decoded by looking up the next PEEK bits
+PEEK = 12
 
-def decode_block(bits: str, m: int, normal_alphabet: bool, start: int = 0) -> tuple[list, int]:
-    block = []
-    i = start
-
-    if normal_alphabet:
-        while i < len(bits):
-            # read command
-            cmd = bits[i:i+4]
-            i += 4
-
-            # read argument
-            if cmd not in {"0010", "0011", "1111"}: # exclude IN, OUT, end block
-                if cmd in {"0100", "1100"}: # loop commands
-                    body, i = decode_block(bits, m, normal_alphabet, i)
-                else:
-                    k, used = golomb_decode(bits[i:], m)
-                    i += used
-
-            match cmd:
-                case "0000": block.append(MOVE(k))
-                case "0001": block.append(CADD(k))
-                case "0010": block.append(IN())
-                case "0011": block.append(OUT())
-                case "0100": block.append(LOOP(body))
-                case "0101": block.append(COPY(k))
-                case "0110": block.append(SET(k))
-                case "0111": block.append(MUL(k))
-                case "1000": block.append(DIV(k))
-                case "1001": block.append(ADD(k))
-                case "1010": block.append(SUB(k))
-                case "1011": block.append(SWAP(k))
-                case "1100": block.append(IFZ(body))
-                case "1101": block.append(CMUL(k))
-                case "1110": block.append(CDIV(k))
-                case "1111": return block, i
+@lru_cache(maxsize=None)
+def golomb_table(m: int) -> list:
+    # window of PEEK bits -> (argument, code length) when the window starts
+    # with a complete Golomb code, else None
+    table = [None] * (1 << PEEK)
+    k = (m - 1).bit_length()
+    t = (1 << k) - m
+    u = 0
+    while True:
+        q, r = divmod(u, m)
+        if q + 1 > PEEK: break
+        if   k == 0: code, length = 1, q + 1
+        elif r < t:  code, length = (1 << (k - 1)) | r, q + k
+        else:        code, length = (1 << k) | (r + t), q + k + 1
+        if length <= PEEK:
+            base = code << (PEEK - length)
+            entry = (unsigned_to_signed(u), length)
+            for low in range(1 << (PEEK - length)):
+                table[base | low] = entry
+        u += 1
+    return table
 
-    else:
-        while i < len(bits):
-            # read command
-            cmd = bits[i:i+5]
-            i += 5
-
-            # read argument
-            if cmd not in {"01010", "01011", "11111"}: # exclude IN, OUT, end block
-                if cmd in {"01100", "11100"}: # loop commands
-                    body, i = decode_block(bits, m, normal_alphabet, i)
-                elif cmd in {
-                    "00110", "01001", "10000", "10001", "10010", "10011",
-                    "10110", "11001", "11011", "11101", "11110"
-                }: # has argument
-                    k, used = golomb_decode(bits[i:], m)
-                    i += used
-
-            match cmd:
-                case "00000": block.append(MOVE(1))
-                case "00001": block.append(MOVE(-1))
-                case "00010": block.append(MOVE(2))
-                case "00011": block.append(MOVE(-2))
-                case "00100": block.append(MOVE(3))
-                case "00101": block.append(MOVE(-3))
-                case "00110": block.append(MOVE(k))
-                case "00111": block.append(CADD(-1))
-                case "01000": block.append(CADD(1))
-                case "01001": block.append(CADD(k))
-                case "01010": block.append(IN())
-                case "01011": block.append(OUT())
-                case "01100": block.append(LOOP(body))
-                case "01101": block.append(COPY(1))
-                case "01110": block.append(COPY(2))
-                case "01111": block.append(COPY(3))
-                case "10000": block.append(COPY(k))
-                case "10001": block.append(SET(k))
-                case "10010": block.append(MUL(k))
-                case "10011": block.append(DIV(k))
-                case "10100": block.append(ADD(-1))
-                case "10101": block.append(ADD(1))
-                case "10110": block.append(ADD(k))
-                case "10111": block.append(SUB(-1))
-                case "11000": block.append(SUB(1))
-                case "11001": block.append(SUB(k))
-                case "11010": block.append(SWAP(1))
-                case "11011": block.append(SWAP(k))
-                case "11100": block.append(IFZ(body))
-                case "11101": block.append(CMUL(k))
-                case "11110": block.append(CDIV(k))
-                case "11111": return block, i
-
-    return block, i
-
-def decode_block_short_alphabet(bits: str, m: int, cmds_bits: str, start: int = 0) -> tuple[list, int]:
-
-    has_block_cmd = False
-    cmds_used = []
-    for j in range(15):
-        if cmds_bits[14 - j] == "1":
-            if Commands[j] is LOOP or Commands[j] is IFZ: has_block_cmd = True
-            cmds_used.append(Commands[j])
+# ------------------------ Opcode tables ------------------------
+# entry per code: (kind, value)
+#   ARG:      value is the class, an argument follows
+#   CONST:    value is the finished instruction (interned, see interpreter.intern)
+#   BLOCK:    value is LOOP or IFZ, a body follows
+#   END:      end of the current block
+#   UNUSED:   not a valid code (short alphabet only)
+
+ARG, CONST, BLOCK, END, UNUSED = range(5)
+
+NORMAL_TABLE = [
+    (ARG, MOVE), (ARG, CADD), (CONST, IN()), (CONST, OUT()), (BLOCK, LOOP),
+    (ARG, COPY), (ARG, SET), (ARG, MUL), (ARG, DIV), (ARG, ADD),
+    (ARG, SUB), (ARG, SWAP), (BLOCK, IFZ), (ARG, CMUL), (ARG, CDIV),
+    (END, None),
+]
+
+EXTENDED_TABLE = [
+    (CONST, MOVE(1)), (CONST, MOVE(-1)), (CONST, MOVE(2)), (CONST, MOVE(-2)),
+    (CONST, MOVE(3)), (CONST, MOVE(-3)), (ARG, MOVE), (CONST, CADD(-1)),
+    (CONST, CADD(1)), (ARG, CADD), (CONST, IN()), (CONST, OUT()),
+    (BLOCK, LOOP), (CONST, COPY(1)), (CONST, COPY(2)), (CONST, COPY(3)),
+    (ARG, COPY), (ARG, SET), (ARG, MUL), (ARG, DIV),
+    (CONST, ADD(-1)), (CONST, ADD(1)), (ARG, ADD), (CONST, SUB(-1)),
+    (CONST, SUB(1)), (ARG, SUB), (CONST, SWAP(1)), (ARG, SWAP),
+    (BLOCK, IFZ), (ARG, CMUL), (ARG, CDIV), (END, None),
+]
+
+NORMAL_TABLE = [(kind, intern(value) if kind == CONST else value) for kind, value in NORMAL_TABLE]
+EXTENDED_TABLE = [(kind, intern(value) if kind == CONST else value) for kind, value in EXTENDED_TABLE]
+
+@lru_cache(maxsize=None)
+def short_table(cmds_mask: int) -> tuple[int, list]:
+    # (code width, table) for a short-alphabet command mask
+
+    cmds_used = [Commands[j] for j in range(15) if cmds_mask >> j & 1]
+    has_block_cmd = LOOP in cmds_used or IFZ in cmds_used
 
     # number of bits used to represent each command
     if has_block_cmd: num_cmds = len(cmds_used) + 1 # +1 for end block
     else:             num_cmds = len(cmds_used)
+    if num_cmds == 0:
+        raise ValueError("short alphabet without commands")
     num_bits = max(1, math.ceil(math.log2(num_cmds)))
 
-    # decode list of commands
-    i = start
+    table = [(UNUSED, None)] * (1 << num_bits)
+    for code, cmd in enumerate(cmds_used):
+        if   cmd is LOOP or cmd is IFZ: table[code] = (BLOCK, cmd)
+        elif cmd is IN or cmd is OUT:   table[code] = (CONST, intern(cmd()))
+        else:                           table[code] = (ARG, cmd)
+    if has_block_cmd:
+        table[-1] = (END, None)  # all 1s: end-of-block marker
+    return num_bits, table
+
+def tail_code(table: list, code: int) -> tuple[int, object]:
+    # (kind, value) for a code cut off by the end of the bits, code being
+    # the bits that are left. As the string decoder before this one read
+    # them: ignored (END) in the extended alphabet, an error in the normal
+    # one, and a shorter code in a short alphabet
+    if table is EXTENDED_TABLE: return END, None
+    if table is NORMAL_TABLE:   raise ValueError("truncated program")
+    kind, value = table[code]
+    if kind == ARG or kind == UNUSED:
+        raise ValueError("truncated program")
+    return kind, value
+
+# ------------------------ Decode ------------------------
+# Blocks are decoded with an explicit stack instead of recursion, so
+# nesting depth isn't limited by Python's recursion limit. A block still
+# open when the bits run out is closed there, as the top level is.
+
+def decode_table(reader: BitReader, m: int, width: int, table: list) -> list:
+    # each step looks at a 25-bit window from the cursor: the opcode is a
+    # table index, and most arguments are a golomb_table index after it
     block = []
-    while i < len(bits):
-
-        # read command
-        cmd_bits = bits[i:i+num_bits]
-        i += num_bits
-        if has_block_cmd and cmd_bits == ("1" * num_bits): return block, i # end-of-block marker
-        cmd = cmds_used[int(cmd_bits, 2)]
-
-        # read argument
-        if cmd is not OUT and cmd is not IN:
-            if cmd is LOOP or cmd is IFZ:
-                body, i = decode_block_short_alphabet(bits, m, cmds_bits, i)
+    stack = []      # (parent block, LOOP/IFZ) for every open body
+
+    data = reader.data + bytes(4)   # windows may run past the end
+    pad = reader.pad
+    end = reader.nbits
+    pos = reader.pos
+    args = golomb_table(m)
+    op_shift = 25 - width
+    arg_shift = op_shift - PEEK
+    arg_mask = (1 << PEEK) - 1
+
+    while pos < end:
+        a = pos + pad
+        window = int.from_bytes(data[a >> 3:(a >> 3) + 4], "big") >> (7 - (a & 7))
+        code = (window >> op_shift) & ((1 << width) - 1)
+        kind, value = table[code]
+        pos += width
+        if pos > end:
+            kind, value = tail_code(table, code >> (pos - end))
+            pos = end
+
+        if kind == ARG:
+            entry = args[(window >> arg_shift) & arg_mask]
+            if entry is None or pos + entry[1] > end:
+                reader.pos = pos
+                k = golomb_decode(reader, m)
+                pos = reader.pos
             else:
-                k, used = golomb_decode(bits[i:], m)
-                i += used
-
-        if   cmd is MOVE: block.append(MOVE(k))
-        elif cmd is CADD: block.append(CADD(k))
-        elif cmd is IN:   block.append(IN())
-        elif cmd is OUT:  block.append(OUT())
-        elif cmd is LOOP: block.append(LOOP(body))
-        elif cmd is COPY: block.append(COPY(k))
-        elif cmd is SET:  block.append(SET(k))
-        elif cmd is MUL:  block.append(MUL(k))
-        elif cmd is DIV:  block.append(DIV(k))
-        elif cmd is ADD:  block.append(ADD(k))
-        elif cmd is SUB:  block.append(SUB(k))
-        elif cmd is SWAP: block.append(SWAP(k))
-        elif cmd is IFZ:  block.append(IFZ(body))
-        elif cmd is CMUL: block.append(CMUL(k))
-        elif cmd is CDIV: block.append(CDIV(k))
-
-    return block, i
+                k, used = entry
+                pos += used
+            if -SMALL <= k <= SMALL: block.append(SMALL_ARGS[value][k])
+            else:                    block.append(value(k))
+        elif kind == CONST:
+            block.append(value)
+        elif kind == BLOCK:
+            stack.append((block, value))
+            block = []
+        elif kind == END:
+            if not stack: break
+            parent, cls = stack.pop()
+            parent.append(cls(block))
+            block = parent
+        else:
+            raise ValueError("unused short alphabet code")
 
+    reader.pos = pos
+    while stack:
+        parent, cls = stack.pop()
+        parent.append(cls(block))
+        block = parent
+    return block
 
-def decode(n: int) -> list:
-    binary = bin(n)[2:] # remove "0b"
+def decode_block(reader: BitReader, m: int, normal_alphabet: bool) -> list:
+    if normal_alphabet: return decode_table(reader, m, 4, NORMAL_TABLE)
+    else:               return decode_table(reader, m, 5, EXTENDED_TABLE)
+
+def decode_block_short_alphabet(reader: BitReader, m: int, cmds_mask: int) -> list:
+    return decode_table(reader, m, *short_table(cmds_mask))
+
+
+def header(reader: BitReader) -> tuple[int, int, list]:
+    # (golomb parameter, code width, opcode table)
+    if reader.nbits < 4:
+        raise ValueError("program integer too small to hold a header")
 
-    if binary[1] == "1":
-        m = int(binary[2:6], 2) + 1          # golomb parameter
-        return decode_block_short_alphabet(binary[21:], m, binary[6:21])[0]
+    reader.read(1)                                  # leading 1
+    if reader.read(1):
+        m = reader.read(4) + 1                      # golomb parameter
+        cmds_mask = reader.read(15)                 # commands used (bit j = Commands[j])
+        return (m, *short_table(cmds_mask))
     else:
-        normal_alphabet = int(binary[2])     # alphabet choice
-        m = int(binary[3:7], 2) + 1          # golomb parameter
-        return decode_block(binary[7:], m, normal_alphabet)[0]
+        normal_alphabet = bool(reader.read(1))      # alphabet choice
+        m = reader.read(min(4, reader.nbits - reader.pos)) + 1  # golomb parameter (cut short: no body)
+        if normal_alphabet: return m, 4, NORMAL_TABLE
+        else:               return m, 5, EXTENDED_TABLE
+
+def decode(n: int) -> list:
+    reader = BitReader.from_int(n)
+    return decode_table(reader, *header(reader))
+
+# ------------------------ Lazy decode ------------------------
+# decode_lazy(n) returns the program as a LazyBlock, which decodes its
+# instructions the first time they're iterated over and keeps them.
+# LOOP/IFZ bodies are LazyBlocks too, so interpret(decode_lazy(n)) (tree
+# engine) starts running at once and never decodes a body that never
+# runs: the codes after a skipped body are found by scanning it, reading
+# code lengths without building instructions. Bad bits (truncation,
+# unused short alphabet codes) raise when decoding or scanning reaches them.
+
+class Source:
+    # the bits of one program and its alphabet, shared by all its blocks
+    def __init__(self, reader: BitReader, m: int, width: int, table: list) -> None:
+        self.reader = reader                # for arguments too long for the golomb table
+        self.data = reader.data + bytes(4)  # windows may run past the end
+        self.pad = reader.pad
+        self.end = reader.nbits
+        self.m = m
+        self.width = width
+        self.table = table
+        self.args = golomb_table(m)
+
+    def code(self, pos: int, build: bool = True) -> tuple:
+        # (kind, value, position after it) for the code at pos; with
+        # build=False, arguments are skipped and value is None for ARG
+        a = pos + self.pad
+        window = int.from_bytes(self.data[a >> 3:(a >> 3) + 4], "big") >> (7 - (a & 7))
+        code = (window >> (25 - self.width)) & ((1 << self.width) - 1)
+        kind, value = self.table[code]
+        pos += self.width
+        if pos > self.end:
+            kind, value = tail_code(self.table, code >> (pos - self.end))
+            pos = self.end
+
+        if kind == ARG:
+            entry = self.args[(window >> (25 - self.width - PEEK)) & ((1 << PEEK) - 1)]
+            if entry is None or pos + entry[1] > self.end:
+                self.reader.pos = pos
+                k = golomb_decode(self.reader, self.m)
+                pos = self.reader.pos
+            else:
+                k, used = entry
+                pos += used
+            if not build:            value = None
+            elif -SMALL <= k <= SMALL: value = SMALL_ARGS[value][k]
+            else:                      value = value(k)
+        elif kind == UNUSED:
+            raise ValueError("unused short alphabet code")
+        return kind, value, pos
+
+class LazyBlock:
+    # iterable like the list decode() would give; a LOOP/IFZ's body
+    def __init__(self, source: Source, pos: int) -> None:
+        self.source = source
+        self.pos = pos          # where decoding continues
+        self.items = []         # instructions decoded so far
+        self.done = False
+        self.child = None       # body of the last LOOP/IFZ decoded: decoding continues at its end
+        self.stop = None        # position after the block's END code, once known
+
+    def __iter__(self):
+        if self.done:
+            return iter(self.items)
+        return self.iterate()
+
+    def iterate(self):
+        i = 0
+        while True:
+            if i < len(self.items):
+                yield self.items[i]
+                i += 1
+            elif self.done:
+                return
+            else:
+                self.step()
+
+    def step(self) -> None:
+        # decode one more instruction, or the end of the block
+        if self.child is not None:
+            self.pos = self.child.end
+            self.child = None
+        if self.pos >= self.source.end:
+            self.done, self.stop = True, self.source.end
+            return
+
+        kind, value, pos = self.source.code(self.pos)
+        if kind == BLOCK:
+            self.child = LazyBlock(self.source, pos)
+            self.items.append(value(self.child))
+        elif kind == END:
+            self.done, self.stop = True, pos
+        else:
+            self.items.append(value)
+            self.pos = pos
+
+    @property
+    def end(self) -> int:
+        # position after the block's END code (or the end of the bits); found
+        # by scanning what hasn't been decoded yet
+        if self.stop is None:
+            pos = self.child.end if self.child is not None else self.pos
+            depth = 0
+            while pos < self.source.end:
+                kind, _, pos = self.source.code(pos, build=False)
+                if kind == BLOCK:
+                    depth += 1
+                elif kind == END:
+                    if depth == 0: break
+                    depth -= 1
+            self.stop = min(pos, self.source.end)
+        return self.stop
+
+def decode_lazy(n: int) -> LazyBlock:
+    reader = BitReader.from_int(n)
+    return LazyBlock(Source(reader, *header(reader)), reader.pos)
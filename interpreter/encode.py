@@ -1,177 +1,464 @@
 from __future__ import annotations
 import math
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from interpreter.interpreter import (
     MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
     IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, Commands
 )
 
+# ------------------------ Bit buffer ------------------------
+
+class BitWriter:
+    # appends codes MSB-first. Codes collect in a small int that is moved
+    # to a bytearray every ~1 KiB, so appending stays O(code length)
+    # instead of copying everything written so far.
+    FLUSH = 8192
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+        self.acc = 0        # pending bits not yet in buf
+        self.nacc = 0
+
+    def write(self, code: int, nbits: int) -> None:
+        self.acc = (self.acc << nbits) | code
+        self.nacc += nbits
+        if self.nacc >= self.FLUSH:
+            keep = self.nacc & 7
+            self.buf += (self.acc >> keep).to_bytes((self.nacc - keep) // 8, "big")
+            self.acc &= (1 << keep) - 1
+            self.nacc = keep
+
+    def __len__(self) -> int:
+        return len(self.buf) * 8 + self.nacc
+
+    def value(self) -> int:
+        return (int.from_bytes(self.buf, "big") << self.nacc) | self.acc
+
+# ------------------------ Codes ------------------------
+
 def signed_to_unsigned(s: int) -> int:
     # ZigZag
     if s >= 0: return 2 * s
     else:      return -2 * s - 1
 
-def golomb_encode(n: int, m: int) -> str:
+def golomb_encode(n: int, m: int) -> tuple[int, int]:
+    # (code, bit length)
     u = signed_to_unsigned(n)
     q, r = divmod(u, m)
 
-    # quotient encoded through unary
-    bits = "0" * q + "1"
+    # quotient encoded through unary: q zeros then a one
+    code, nbits = 1, q + 1
 
     # remainder encoded through truncated binary
     k = (m - 1).bit_length()
-    if k == 0: return bits
-    
-    t = (1 << k) - m
-    if r < t: bits += format(r,     f"0{k-1}b")
-    else:     bits += format(r + t, f"0{k}b")
-    return bits
-
-
-def encode_block(block: list, m: int, normal_alphabet: bool) -> str:
-    bits = ""
-
-    if normal_alphabet:
-        for cmd in block:
-            if isinstance(cmd, LOOP) or isinstance(cmd, IFZ):
-                k = encode_block(cmd.body, m, normal_alphabet) + "1111"
-            elif not isinstance(cmd, OUT) and not isinstance(cmd, IN): # has arguments
-                k = golomb_encode(cmd.k, m)
-
-            if   isinstance(cmd, MOVE): bits += "0000" + k
-            elif isinstance(cmd, CADD): bits += "0001" + k
-            elif isinstance(cmd, IN):   bits += "0010"
-            elif isinstance(cmd, OUT):  bits += "0011"
-            elif isinstance(cmd, LOOP): bits += "0100" + k
-            elif isinstance(cmd, COPY): bits += "0101" + k
-            elif isinstance(cmd, SET):  bits += "0110" + k
-            elif isinstance(cmd, MUL):  bits += "0111" + k
-            elif isinstance(cmd, DIV):  bits += "1000" + k
-            elif isinstance(cmd, ADD):  bits += "1001" + k
-            elif isinstance(cmd, SUB):  bits += "1010" + k
-            elif isinstance(cmd, SWAP): bits += "1011" + k
-            elif isinstance(cmd, IFZ):  bits += "1100" + k
-            elif isinstance(cmd, CMUL): bits += "1101" + k
-            elif isinstance(cmd, CDIV): bits += "1110" + k
-            else:
-                raise TypeError(f"Unknown instruction: {cmd}")
-
-    else:
-        for cmd in block:
-            if isinstance(cmd, MOVE):
-                if   cmd.k == 1:    bits += "00000"
-                elif cmd.k == -1:   bits += "00001"
-                elif cmd.k == 2:    bits += "00010"
-                elif cmd.k == -2:   bits += "00011"
-                elif cmd.k == 3:    bits += "00100"
-                elif cmd.k == -3:   bits += "00101"
-                else:               bits += "00110" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, CADD):
-                if   cmd.k == -1:   bits += "00111"
-                elif cmd.k == 1:    bits += "01000"
-                else:               bits += "01001" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, IN):
-                                    bits += "01010"
-
-            elif isinstance(cmd, OUT):
-                                    bits += "01011"
-
-            elif isinstance(cmd, LOOP):
-                                    bits += "01100" + encode_block(cmd.body, m, normal_alphabet) + "11111"
-
-            elif isinstance(cmd, COPY):
-                if cmd.k == 1:      bits += "01101"
-                elif cmd.k == 2:    bits += "01110"
-                elif cmd.k == 3:    bits += "01111"
-                else:               bits += "10000" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, SET):
-                                    bits += "10001" + golomb_encode(cmd.k, m)
-            elif isinstance(cmd, MUL):
-                                    bits += "10010" + golomb_encode(cmd.k, m)
-            elif isinstance(cmd, DIV):
-                                    bits += "10011" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, ADD):
-                if   cmd.k == -1: bits += "10100"
-                elif cmd.k == 1:  bits += "10101"
-                else:             bits += "10110" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, SUB):
-                if   cmd.k == -1:   bits += "10111"
-                elif cmd.k == 1:    bits += "11000"
-                else:               bits += "11001" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, SWAP):
-                if cmd.k == 1:      bits += "11010"
-                else:               bits += "11011" + golomb_encode(cmd.k, m)
-
-            elif isinstance(cmd, IFZ):
-                                    bits += "11100" + encode_block(cmd.body, m, normal_alphabet) + "11111"
-            elif isinstance(cmd, CMUL):
-                                    bits += "11101" + golomb_encode(cmd.k, m)
-            elif isinstance(cmd, CDIV):
-                                    bits += "11110" + golomb_encode(cmd.k, m)
-            else:
-                raise TypeError(f"Unknown instruction: {cmd}")
-
-    return bits
+    if k == 0: return code, nbits
 
-def encode_block_short_alphabet(block: list, m: int) -> str:
-    bits = ""
+    t = (1 << k) - m
+    if r < t: return (code << (k - 1)) | r,       nbits + k - 1
+    else:     return (code << k)       | (r + t), nbits + k
+
+
+# normal alphabet: 4-bit code per command
+NORMAL_CODES = {
+    MOVE: 0b0000, CADD: 0b0001, IN:   0b0010, OUT:  0b0011, LOOP: 0b0100,
+    COPY: 0b0101, SET:  0b0110, MUL:  0b0111, DIV:  0b1000, ADD:  0b1001,
+    SUB:  0b1010, SWAP: 0b1011, IFZ:  0b1100, CMUL: 0b1101, CDIV: 0b1110,
+}
+
+# extended alphabet: 5-bit codes that include their argument...
+EXTENDED_FIXED = {
+    (MOVE, 1):  0b00000, (MOVE, -1): 0b00001, (MOVE, 2):  0b00010,
+    (MOVE, -2): 0b00011, (MOVE, 3):  0b00100, (MOVE, -3): 0b00101,
+    (CADD, -1): 0b00111, (CADD, 1):  0b01000,
+    (COPY, 1):  0b01101, (COPY, 2):  0b01110, (COPY, 3):  0b01111,
+    (ADD, -1):  0b10100, (ADD, 1):   0b10101,
+    (SUB, -1):  0b10111, (SUB, 1):   0b11000,
+    (SWAP, 1):  0b11010,
+}
+
+# ...and the generic ones, followed by an argument (or block)
+EXTENDED_CODES = {
+    MOVE: 0b00110, CADD: 0b01001, IN:   0b01010, OUT:  0b01011, LOOP: 0b01100,
+    COPY: 0b10000, SET:  0b10001, MUL:  0b10010, DIV:  0b10011, ADD:  0b10110,
+    SUB:  0b11001, SWAP: 0b11011, IFZ:  0b11100, CMUL: 0b11101, CDIV: 0b11110,
+}
+
+# ------------------------ Encode ------------------------
+
+def encode_block(block: list, m: int, normal_alphabet: bool, w: BitWriter) -> None:
+    width = 4 if normal_alphabet else 5
+    end_block = (1 << width) - 1
 
-    # names/types of the commands in block
-    block_types = set()
     for cmd in block:
-        block_types.add(type(cmd))
+        cls = type(cmd)
+        if cls not in NORMAL_CODES:
+            raise TypeError(f"Unknown instruction: {cmd}")
+
+        if normal_alphabet:
+            code = NORMAL_CODES[cls]
+        elif cls is not LOOP and cls is not IFZ and (cls, getattr(cmd, "k", None)) in EXTENDED_FIXED:
+            w.write(EXTENDED_FIXED[(cls, cmd.k)], 5)
+            continue
+        else:
+            code = EXTENDED_CODES[cls]
 
-    # encode what commands are in block
+        # arguments
+        if cls is LOOP or cls is IFZ:
+            w.write(code, width)
+            encode_block(cmd.body, m, normal_alphabet, w)
+            w.write(end_block, width)
+        elif cls is OUT or cls is IN:
+            w.write(code, width)
+        else:
+            arg, nbits = golomb_encode(cmd.k, m)
+            w.write((code << nbits) | arg, width + nbits)
+
+def short_alphabet(block_types: set) -> tuple[int, dict, int]:
+    # (mask, command -> code, bits per code) of a block with these commands
     cmds = []
+    mask = 0
     for cmd in Commands[::-1]: # less frequent to more frequent
+        mask <<= 1
         if cmd in block_types:
-            bits += "1"
+            mask |= 1
             cmds.append(cmd)
-        else:
-            bits += "0"
-    cmds.reverse() 
+    cmds.reverse()
+    index = {cmd: i for i, cmd in enumerate(cmds)}
 
     # number of bits used to represent each command
     if IFZ in cmds or LOOP in cmds: num_cmds = len(cmds) + 1 # +1 for end block
     else:                           num_cmds = len(cmds)
     num_bits = max(1, math.ceil(math.log2(num_cmds)))
+    return mask, index, num_bits
+
+def encode_block_short_alphabet(block: list, m: int, w: BitWriter) -> None:
+    # encode what commands are in block, then the commands
+    mask, index, num_bits = short_alphabet({type(cmd) for cmd in block})
+    w.write(mask, 15)
+    encode_commands_short_alphabet(block, m, index, num_bits, w)
 
-    # encode the list of commands
+def encode_commands_short_alphabet(block: list, m: int, index: dict, num_bits: int, w: BitWriter) -> None:
     for cmd in block:
-        bits += format(cmds.index(type(cmd)), f"0{num_bits}b") # individual code for each command
+        cls = type(cmd)
+        if cls not in index:
+            raise TypeError(f"Unknown instruction: {cmd}")
+        w.write(index[cls], num_bits) # individual code for each command
 
         # arguments
-        if isinstance(cmd, LOOP) or isinstance(cmd, IFZ):
-            bits += encode_block_short_alphabet(cmd.body, m) + "1" * num_bits
-        elif not isinstance(cmd, OUT) and not isinstance(cmd, IN): # has arguments
-            bits += golomb_encode(cmd.k, m)
-
-    return bits
-
-
-def encode(program: list) -> int:
-
-    # compute optimal golomb parameter
-    def optimal_golomb(program: list, method: str, normal_alphabet: bool) -> int:
-        m_list = []
-        for m in range(1, 17):
-            if method == "normal":
-                header = "0" + str(int(normal_alphabet)) + format(m - 1, "04b")
-                m_list.append(int("1" + header + encode_block(program, m, normal_alphabet), 2))
-            elif method == "short_alphabet":
-                header = "1" + format(m - 1, "04b")
-                m_list.append(int("1" + header + encode_block_short_alphabet(program, m), 2))
-
-        return min(m_list)
-
-    # return the smallest program
-    candidates = []
+        if cls is LOOP or cls is IFZ:
+            encode_block_short_alphabet(cmd.body, m, w)
+            w.write((1 << num_bits) - 1, num_bits)
+        elif cls is not OUT and cls is not IN: # has arguments
+            w.write(*golomb_encode(cmd.k, m))
+
+
+def with_header(header: int, header_bits: int, w: BitWriter) -> int:
+    # leading 1, header, then the body
+    return (((1 << header_bits) | header) << len(w)) | w.value()
+
+def encode_with(program: list, method: str, normal_alphabet: bool, m: int) -> int:
+    # the program under one configuration
+    w = BitWriter()
+    if method == "normal":
+        encode_block(program, m, normal_alphabet, w)
+        return with_header((int(normal_alphabet) << 4) | (m - 1), 6, w)
+    elif method == "short_alphabet":
+        encode_block_short_alphabet(program, m, w)
+        return with_header((1 << 4) | (m - 1), 5, w)
+    raise ValueError(f"Unknown method: {method}")
+
+# ------------------------ Cost model ------------------------
+
+def golomb_length(u: int, m: int) -> int:
+    # bit length of golomb_encode for an already ZigZag'd u
+    q, r = divmod(u, m)
+    k = (m - 1).bit_length()
+    if k == 0:           return q + 1
+    if r < (1 << k) - m: return q + k
+    return q + 1 + k
+
+def new_statistics() -> dict:
+    return {
+        "commands": 0,          # instructions, blocks included
+        "blocks": 0,            # LOOP/IFZ (each adds an end-of-block code)
+        "normal_args": {},      # ZigZag'd argument -> count, normal alphabet
+        "extended_args": {},    # same, minus arguments built into extended codes
+        "short_codes": 0,       # bits of short-alphabet masks and command codes,
+    }                           # None when the method can't encode the program
+
+def add_short_block(stats: dict, types: set, length: int, nested: int) -> None:
+    # short-alphabet cost of one block: its mask and one code per
+    # instruction and per end-of-block of a nested LOOP/IFZ
+    num_cmds = len(types) + (LOOP in types or IFZ in types)
+    if num_cmds == 0:
+        stats["short_codes"] = None   # empty block: no alphabet to build
+    elif stats["short_codes"] is not None:
+        num_bits = max(1, math.ceil(math.log2(num_cmds)))
+        stats["short_codes"] += 15 + num_bits * (length + nested)
+
+def gather(block: list, stats: dict) -> tuple[set, int, int]:
+    # adds block's instructions to stats, and the short-alphabet cost of the
+    # blocks nested in it; returns block's own (types, length, nested) so
+    # the caller can cost it, possibly together with the rest of its block
+    types = set()
+    nested = 0
+    for cmd in block:
+        cls = type(cmd)
+        if cls not in NORMAL_CODES:
+            raise TypeError(f"Unknown instruction: {cmd}")
+        types.add(cls)
+        stats["commands"] += 1
+        if cls is LOOP or cls is IFZ:
+            nested += 1
+            stats["blocks"] += 1
+            add_short_block(stats, *gather(cmd.body, stats))
+        elif cls is not OUT and cls is not IN:
+            u = signed_to_unsigned(cmd.k)
+            stats["normal_args"][u] = stats["normal_args"].get(u, 0) + 1
+            if (cls, cmd.k) not in EXTENDED_FIXED:
+                stats["extended_args"][u] = stats["extended_args"].get(u, 0) + 1
+    return types, len(block), nested
+
+def statistics(program: list) -> dict:
+    # everything encoded_length needs, gathered in one pass
+    stats = new_statistics()
+    add_short_block(stats, *gather(program, stats))
+    return stats
+
+def encoded_length(stats: dict, method: str, normal_alphabet: bool, m: int) -> int | None:
+    # bit length of encode_with(...) without encoding; None if not encodable
+    if method == "short_alphabet":
+        if stats["short_codes"] is None: return None
+        args = stats["normal_args"]
+        body = stats["short_codes"]
+        header = 6
+    else:
+        width = 4 if normal_alphabet else 5
+        args = stats["normal_args"] if normal_alphabet else stats["extended_args"]
+        body = width * (stats["commands"] + stats["blocks"])
+        header = 7
+    return header + body + sum(count * golomb_length(u, m) for u, count in args.items())
+
+# ------------------------ Encode ------------------------
+
+def shortest_configs(stats: dict) -> list:
+    # The smallest integer is the shortest bitstring (all start with a 1),
+    # so rank the configurations by their computed length and only encode
+    # the ones tied for shortest, letting their contents break the tie.
+    lengths = {}
     pair = [["normal", True], ["normal", False], ["short_alphabet", True]]
     for method, normal_alphabet in pair:
-        candidates.append(optimal_golomb(program, method, normal_alphabet))
-    return min(candidates)
+        for m in range(1, 17):
+            length = encoded_length(stats, method, normal_alphabet, m)
+            if length is not None:
+                lengths[(method, normal_alphabet, m)] = length
+
+    shortest = min(lengths.values())
+    return [config for config, length in lengths.items() if length == shortest]
+
+def encoded_size(program: list) -> int:
+    # bit length of encode(program), without encoding it
+    stats = statistics(program)
+    return encoded_length(stats, *shortest_configs(stats)[0])
+
+def encode(program: list, workers: int | None = None) -> int:
+    # workers: gather statistics and encode in a process pool of up to
+    # that many processes, no more than there are usable CPUs, when that
+    # leaves at least MIN_WORKERS and the program has at least PARALLEL_MIN
+    # instructions. Same result either way.
+    if workers is not None:
+        workers = min(workers, usable_cpus())
+    if workers is not None and workers >= MIN_WORKERS:
+        sizes = {}
+        if count(program, sizes) >= PARALLEL_MIN:
+            return encode_parallel(program, workers, sizes)
+
+    stats = statistics(program)
+    return min(encode_with(program, *config) for config in shortest_configs(stats))
+
+# ------------------------ Parallel ------------------------
+# The program is cut into pieces of about PIECE instructions: runs of
+# consecutive instructions of one block, and the LOOP/IFZ around a body too
+# big for one piece, whose body is cut up in turn. Runs are packed into
+# tuples of ints and pickled once; the workers gather statistics for, and
+# encode, the runs, and the LOOP/IFZ codes, short-alphabet masks and
+# per-block short-alphabet costs are filled in here.
+#
+# Packing and pickling the runs stays in this process and costs about a
+# third of a serial encode(), and unpacking makes the workers' share
+# about 1.4 times a serial encode(), so the pool can only win with
+# MIN_WORKERS or more CPUs to run on (bench.py's "encode workers" entries
+# measure it). With fewer usable CPUs, or a program under PARALLEL_MIN
+# instructions, encode() stays serial.
+
+PIECE = 20_000
+PARALLEL_MIN = 4 * PIECE
+MIN_WORKERS = 3
+
+def usable_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+RUN, OPEN, CLOSE = range(3)
+
+def count(block: list, sizes: dict) -> int:
+    # instructions in block, nested ones included; records the size of
+    # every LOOP/IFZ body in sizes (by id)
+    total = 0
+    for cmd in block:
+        total += 1
+        if type(cmd) is LOOP or type(cmd) is IFZ:
+            sizes[id(cmd)] = count(cmd.body, sizes)
+            total += sizes[id(cmd)]
+    return total
+
+def split(block: list, path: tuple, sizes: dict, pieces: list) -> None:
+    # pieces: (RUN, path, start, stop), (OPEN, path, cls, inner), (CLOSE, inner)
+    # where path is the indices leading from the program to the block, and
+    # inner the path of the opened LOOP/IFZ's body
+    start = size = 0
+    for j, cmd in enumerate(block):
+        n = 1 + sizes.get(id(cmd), 0)
+        if n > PIECE:
+            if start < j: pieces.append((RUN, path, start, j))
+            pieces.append((OPEN, path, type(cmd), path + (j,)))
+            split(cmd.body, path + (j,), sizes, pieces)
+            pieces.append((CLOSE, path + (j,)))
+            start, size = j + 1, 0
+            continue
+        size += n
+        if size >= PIECE:
+            pieces.append((RUN, path, start, j + 1))
+            start, size = j + 1, 0
+    if start < len(block):
+        pieces.append((RUN, path, start, len(block)))
+
+COMMAND_INDEX = {cls: index for index, cls in enumerate(Commands)}
+
+def pack(block: list) -> tuple:
+    # compact form sent to the workers: (index in Commands, argument or body)
+    packed = []
+    for cmd in block:
+        cls = type(cmd)
+        if cls not in NORMAL_CODES:
+            raise TypeError(f"Unknown instruction: {cmd}")
+        if cls is LOOP or cls is IFZ: packed.append((COMMAND_INDEX[cls], pack(cmd.body)))
+        else:                         packed.append((COMMAND_INDEX[cls], getattr(cmd, "k", 0)))
+    return tuple(packed)
+
+def unpack(packed: tuple, made: dict | None = None) -> list:
+    # instructions with the same command and argument come back as one
+    # shared instance (the encoder never modifies them)
+    made = {} if made is None else made
+    block = []
+    for item in packed:
+        cls = Commands[item[0]]
+        if cls is LOOP or cls is IFZ:
+            block.append(cls(unpack(item[1], made)))
+            continue
+        cmd = made.get(item)
+        if cmd is None:
+            cmd = made[item] = cls() if cls is OUT or cls is IN else cls(item[1])
+        block.append(cmd)
+    return block
+
+def gather_run(run: bytes) -> tuple[dict, tuple]:
+    stats = new_statistics()
+    level = gather(unpack(pickle.loads(run)), stats)
+    return stats, level
+
+def encode_run(run: bytes, m: int, normal_alphabet: bool, block_types: set | None) -> tuple[int, int]:
+    # block_types: the commands of the run's block, for the short alphabet;
+    # None for the normal and extended alphabets
+    w = BitWriter()
+    block = unpack(pickle.loads(run))
+    if block_types is None:
+        encode_block(block, m, normal_alphabet, w)
+    else:
+        _, index, num_bits = short_alphabet(block_types)
+        encode_commands_short_alphabet(block, m, index, num_bits, w)
+    return w.value(), len(w)
+
+def merge_statistics(stats: dict, part: dict) -> None:
+    stats["commands"] += part["commands"]
+    stats["blocks"] += part["blocks"]
+    for key in ("normal_args", "extended_args"):
+        for u, n in part[key].items():
+            stats[key][u] = stats[key].get(u, 0) + n
+    if part["short_codes"] is None or stats["short_codes"] is None:
+        stats["short_codes"] = None
+    else:
+        stats["short_codes"] += part["short_codes"]
+
+def encode_parallel(program: list, workers: int, sizes: dict) -> int:
+    pieces = []
+    split(program, (), sizes, pieces)
+    paths, runs = [], []
+    for piece in pieces:
+        if piece[0] == RUN:
+            _, path, start, stop = piece
+            block = program
+            for j in path:
+                block = block[j].body
+            paths.append(path)
+            runs.append(pickle.dumps(pack(block[start:stop]), pickle.HIGHEST_PROTOCOL))
+
+    with ProcessPoolExecutor(workers) as pool:
+        # statistics: runs add up, and each split block's own level is
+        # collected from its runs and OPENs before it's costed
+        stats = new_statistics()
+        levels = {}     # path -> [types, length, nested]
+        for path, (part, (types, length, nested)) in zip(paths, pool.map(gather_run, runs)):
+            merge_statistics(stats, part)
+            level = levels.setdefault(path, [set(), 0, 0])
+            level[0] |= types
+            level[1] += length
+            level[2] += nested
+        for piece in pieces:
+            if piece[0] == OPEN:
+                _, path, cls, _ = piece
+                stats["commands"] += 1
+                stats["blocks"] += 1
+                level = levels.setdefault(path, [set(), 0, 0])
+                level[0].add(cls)
+                level[1] += 1
+                level[2] += 1
+        for types, length, nested in levels.values():
+            add_short_block(stats, types, length, nested)
+
+        encodings = []
+        for method, normal_alphabet, m in shortest_configs(stats):
+            if method == "normal":
+                width = 4 if normal_alphabet else 5
+                codes = NORMAL_CODES if normal_alphabet else EXTENDED_CODES
+                block_types = [None] * len(runs)
+            else:
+                alphabets = {path: short_alphabet(level[0]) for path, level in levels.items()}
+                block_types = [levels[path][0] for path in paths]
+
+            encoded = iter(pool.map(encode_run, runs, [m] * len(runs), [normal_alphabet] * len(runs), block_types))
+            w = BitWriter()
+            if method != "normal":
+                w.write(alphabets[()][0], 15)
+            for piece in pieces:
+                if piece[0] == RUN:
+                    w.write(*next(encoded))
+                elif method == "normal":
+                    if piece[0] == OPEN: w.write(codes[piece[2]], width)
+                    else:                w.write((1 << width) - 1, width)
+                elif piece[0] == OPEN:
+                    # the LOOP/IFZ's code in its block's alphabet, then its body's mask
+                    _, path, cls, inner = piece
+                    _, index, num_bits = alphabets[path]
+                    w.write(index[cls], num_bits)
+                    w.write(alphabets[inner][0], 15)
+                else:
+                    _, _, num_bits = alphabets[piece[1][:-1]]
+                    w.write((1 << num_bits) - 1, num_bits)
+
+            if method == "normal": encodings.append(with_header((int(normal_alphabet) << 4) | (m - 1), 6, w))
+            else:                  encodings.append(with_header((1 << 4) | (m - 1), 5, w))
+        return min(encodings)
@@ -1,71 +1,324 @@
 from __future__ import annotations
+import io
+import math
+from collections import OrderedDict
+from collections.abc import Iterator
 from dataclasses import dataclass
+from typing import BinaryIO
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
 
 # ------------------------ Instructions ------------------------
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class MOVE:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CADD:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class IN:
     pass
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class OUT:
     pass
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class LOOP:
     body: list
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class COPY:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SET:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class MUL:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DIV:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ADD:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SUB:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SWAP:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class IFZ:
     body: list
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CMUL:
     k: int
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CDIV:
     k: int
 
 Commands = [MOVE, CADD, IN, OUT, LOOP, COPY, SET, MUL, DIV, ADD, SUB, SWAP, IFZ, CMUL, CDIV]
 
+# ------------------------ Internal instructions ------------------------
+# produced by interpreter.optimize; interpret() runs them, encode() can't
+
+@dataclass(frozen=True, slots=True)
+class COUNTDOWN:
+    # a LOOP whose current cell steps down by 1 to 0 while other cells are
+    # only offset or scaled: runs in closed form when the counter is
+    # positive, and as the original loop (which never ends) when negative.
+    # adds/muls entries: (offset, const, ((cell offset, sign), ...), ((shift, sign), ...))
+    # where a shift is a read of the counter, as (value read) - (counter at iteration start)
+    adds: tuple
+    muls: tuple
+    loop: LOOP
+
+@dataclass(frozen=True, slots=True)
+class AT:
+    # ins (never MOVE, LOOP or IFZ) applied as if the pointer were
+    # offset cells further along, without moving it
+    offset: int
+    ins: object
+
+@dataclass(frozen=True, slots=True)
+class MEMO:
+    # a LOOP/IFZ (block) with no IN/OUT that leaves the pointer where it
+    # found it (see analysis.effect): its effect depends only on the cells
+    # at offsets `reads` and changes only those at `writes`, so the tree
+    # engine runs it once per distinct set of read values and replays the
+    # written values after that. The recorded values belong to the run
+    # (see interpret), not the instruction, so a MEMO is as immutable and
+    # shareable as the rest
+    block: object
+    reads: tuple
+    writes: tuple
+
+def range_product(lo: int, hi: int) -> int:
+    # lo * (lo+1) * ... * hi
+    if lo > hi:            return 1
+    if lo <= 0 <= hi:      return 0
+    if lo > 0:             return math.perm(hi, hi - lo + 1)
+    count = hi - lo + 1
+    return (-1) ** count * math.perm(-lo, count)
+
+def countdown_effects(ins: COUNTDOWN, n: int, cell) -> list:
+    # (offset, value) for every cell the loop changes when its counter starts
+    # at n > 0; cell(offset) reads the tape relative to the pointer
+    effects = []
+    for offset, const, cells, shifts in ins.adds:
+        v = cell(offset) + n * const
+        for src, sign in cells:  v += sign * n * cell(src)
+        for e, sign in shifts:   v += sign * (n * (n + 1) // 2 + e * n)
+        effects.append((offset, v))
+    for offset, const, cells, shifts in ins.muls:
+        v = cell(offset) * const ** n
+        for src, _ in cells:     v *= cell(src) ** n
+        for e, _ in shifts:      v *= range_product(1 + e, n + e)
+        effects.append((offset, v))
+    effects.append((0, 0))
+    return effects
+
+def countdown_bits(ins: COUNTDOWN, n: int, cell) -> int:
+    # an upper bound on the bit length of the cells countdown_effects
+    # writes, without computing them (a multiplying countdown's cells take
+    # about n times the bits of their factors)
+    def log(v) -> int:
+        return (abs(v) - 1).bit_length()       # bits of |v|**n <= n * log(v) + 1
+    bits = 0
+    for offset, const, cells, shifts in ins.adds:
+        terms = [log(n) + log(const)] + [log(n) + log(cell(src)) for src, _ in cells]
+        terms += [2 * log(n + abs(e) + 1) for e, _ in shifts]
+        bits = max(bits, max(log(cell(offset)), *terms) + len(terms) + 3)
+    for offset, const, cells, shifts in ins.muls:
+        factors = log(const) + sum(log(cell(src)) for src, _ in cells)
+        factors += sum(log(abs(n) + abs(e) + 1) for e, _ in shifts)
+        bits = max(bits, log(cell(offset)) + n * factors + 1)
+    return bits
+
+# results: one MEMO's read values -> written values during a run. At
+# most MEMO_ENTRIES, least recently used evicted; results whose read and
+# written values take more than MEMO_BITS bits in total aren't kept (too
+# costly to hash and hold, and unlikely to recur)
+MEMO_ENTRIES = 4096
+MEMO_BITS = 1 << 12
+
+def memo_recall(results: OrderedDict, key: tuple) -> tuple | None:
+    # the written values recorded for these read values, if any
+    values = results.get(key)
+    if values is not None:
+        results.move_to_end(key)
+    return values
+
+def memo_record(results: OrderedDict, key: tuple, values: tuple) -> None:
+    if sum(v.bit_length() for v in key) + sum(v.bit_length() for v in values) > MEMO_BITS:
+        return
+    results[key] = values
+    if len(results) > MEMO_ENTRIES:
+        results.popitem(last=False)
+
+# ------------------------ Representation ------------------------
+# Instructions are immutable, so equal ones can be shared: decode() and
+# freeze() hand out one instance of IN(), OUT() and every instruction
+# with an argument in -SMALL..SMALL. freeze() also turns LOOP/IFZ bodies
+# into tuples, which makes a program hashable (usable as a cache key);
+# thaw() turns them back into lists.
+
+SMALL = 64
+
+# class -> instances for arguments -SMALL..SMALL, indexed by the argument
+SMALL_ARGS = {
+    cls: [cls(k) for k in range(SMALL + 1)] + [cls(k) for k in range(-SMALL, 0)]
+    for cls in (MOVE, CADD, COPY, SET, MUL, DIV, ADD, SUB, SWAP, CMUL, CDIV)
+}
+SINGLETONS = {IN: IN(), OUT: OUT()}
+
+def intern(ins):
+    # the shared instance equal to ins, if there is one
+    cls = type(ins)
+    if cls in SINGLETONS:                              return SINGLETONS[cls]
+    if cls in SMALL_ARGS and -SMALL <= ins.k <= SMALL: return SMALL_ARGS[cls][ins.k]
+    return ins
+
+def freeze(program) -> tuple:
+    frozen = []
+    for ins in program:
+        cls = type(ins)
+        if   cls is LOOP or cls is IFZ: frozen.append(cls(freeze(ins.body)))
+        elif cls is COUNTDOWN:          frozen.append(COUNTDOWN(ins.adds, ins.muls, LOOP(freeze(ins.loop.body))))
+        elif cls is MEMO:               frozen.append(MEMO(freeze([ins.block])[0], ins.reads, ins.writes))
+        elif cls is AT:                 frozen.append(AT(ins.offset, intern(ins.ins)))
+        else:                           frozen.append(intern(ins))
+    return tuple(frozen)
+
+def thaw(program) -> list:
+    thawed = []
+    for ins in program:
+        cls = type(ins)
+        if   cls is LOOP or cls is IFZ: thawed.append(cls(thaw(ins.body)))
+        elif cls is COUNTDOWN:          thawed.append(COUNTDOWN(ins.adds, ins.muls, LOOP(thaw(ins.loop.body))))
+        elif cls is MEMO:               thawed.append(MEMO(thaw([ins.block])[0], ins.reads, ins.writes))
+        else:                           thawed.append(ins)
+    return thawed
+
+# ------------------------ Input ------------------------
+
+class InputReader:
+    # IN: the bytes up to the next newline (or EOF) as a signed big-endian
+    # integer, 0 for an empty line or once input is exhausted.
+    # input is either a buffer with find() (bytes, bytearray, mmap), read
+    # in place, or a binary stream with readline() (file, pipe, socket
+    # file), read one line at a time so memory stays bounded by the longest line
+    def __init__(self, input: bytes | BinaryIO, pos: int = 0) -> None:
+        self.pos = pos      # bytes consumed so far (where a buffer is resumed from)
+        if not hasattr(input, "find") and hasattr(input, "readline"):
+            if isinstance(input, io.RawIOBase):
+                input = io.BufferedReader(input)
+            self.buffer = None
+            self.readline = input.readline
+        else:
+            self.buffer = input if hasattr(input, "find") else bytes(input)
+
+    def __call__(self) -> int:
+        if self.buffer is None:
+            chunk = self.readline()
+            self.pos += len(chunk)
+            if chunk.endswith(b"\n"):
+                chunk = chunk[:-1]
+        else:
+            input, in_pos = self.buffer, self.pos
+            if in_pos >= len(input):
+                return 0
+            newline_pos = input.find(b"\n", in_pos)
+            if newline_pos == -1:
+                chunk = input[in_pos:]
+                self.pos = len(input)
+            else:
+                chunk = input[in_pos:newline_pos]
+                self.pos = newline_pos + 1
+        if len(chunk) == 1:     # the common case, without the from_bytes call
+            b = chunk[0]
+            return b - 256 if b > 127 else b
+        return int.from_bytes(chunk, byteorder="big", signed=True) if chunk else 0
+
+class InputPending(Exception):
+    # raised by an input's readline() when the next line hasn't arrived
+    # yet: vm.Machine.run stops with INPUT before the IN, and running it
+    # again retries the IN (see interpreter.aio)
+    pass
+
+# ------------------------ Output ------------------------
+# OUT writes the cell as a signed big-endian integer in
+# (bit_length + 8) // 8 bytes, at least one (so -128 takes two). Engines
+# write cells in -127..127 (one byte) with a single append, and call
+# cell_bytes for anything else.
+
+def cell_bytes(v: int) -> bytes:
+    if type(v) is not int:
+        v = int(v)      # an mpz (arithmetic="gmpy2")
+    return v.to_bytes(max(1, (v.bit_length() + 8) // 8), byteorder="big", signed=True)
+
+# ------------------------ Arithmetic ------------------------
+# Cells are Python ints. arithmetic="gmpy2" keeps them as gmpy2 mpz values
+# instead, which multiply and divide huge numbers a few times faster (and
+# small ones a bit slower), for programs whose cells grow to thousands of
+# digits; without gmpy2 installed it falls back to ints. Only the values a
+# cell can start from (0, SET, IN) are converted, arithmetic on an mpz
+# gives an mpz.
+
+ARITHMETIC = ("int", "gmpy2")
+
+def number_type(arithmetic: str) -> type:
+    if arithmetic not in ARITHMETIC:
+        raise ValueError(f"Unknown arithmetic: {arithmetic}")
+    if arithmetic == "gmpy2" and gmpy2 is not None:
+        return gmpy2.mpz
+    return int
+
 # ------------------------ Interpret ------------------------
 
-def interpret(program: list, input: bytes = b"") -> bytes:
+def interpret(program: list, input: bytes | BinaryIO = b"", engine: str = "tree", profile=None,
+              arithmetic: str = "int") -> bytes:
+    # engine: "tree"   walks the instruction lists directly,
+    #         "vm"     compiles them to flat bytecode first (interpreter.vm)
+    #         "native" compiles them to a Python function (interpreter.native)
+    # profile: an interpreter.profiler.Profile to record the run into, using
+    #          a separate, instrumented tree engine
+    # arithmetic: "int" or "gmpy2", see number_type (tree and vm engines)
+    # The tree engine (and profiler) also runs interpreter.decode.decode_lazy
+    # programs, decoding only the code that runs; the others need it all.
+    number = number_type(arithmetic)
+    if profile is not None:
+        if engine != "tree":
+            raise ValueError(f"Engine can't profile: {engine}")
+        from interpreter.profiler import run
+        return run(program, input, profile)
+    elif engine == "vm":
+        from interpreter.vm import assemble, run
+        return run(assemble(program), input, arithmetic)
+    elif engine == "native":
+        if number is not int:
+            raise ValueError(f"Engine can't use arithmetic: {arithmetic}")
+        from interpreter.native import compile_program, execute
+        return b"".join(execute(compile_program(program), input))
+    elif engine != "tree":
+        raise ValueError(f"Unknown engine: {engine}")
+
     tape = {}
     ptr = 0
-    in_pos = 0
+    read = InputReader(input)
     out = bytearray()
+    zero = number(0)
+    memos = {}          # id of a MEMO -> its results, for this run only
 
     def set_cell(i: int, v: int) -> None:
         tape[i] = v
     def get_cell(i: int) -> int:
-        return tape.get(i, 0)
+        return tape.get(i, zero)
 
     def exec_block(block: list) -> None:
-        nonlocal ptr, in_pos
+        nonlocal ptr
         for ins in block:
 
             if isinstance(ins, MOVE):
@@ -75,7 +328,7 @@ def interpret(program: list, input: bytes = b"") -> bytes:
                 set_cell(ptr, get_cell(ptr) + ins.k)
 
             elif isinstance(ins, SET):
-                set_cell(ptr, ins.k)
+                set_cell(ptr, ins.k if number is int else number(ins.k))
 
             elif isinstance(ins, ADD):
                 set_cell(ptr, get_cell(ptr) + get_cell(ptr + ins.k))
@@ -102,25 +355,12 @@ def interpret(program: list, input: bytes = b"") -> bytes:
         
             elif isinstance(ins, OUT):
                 v = get_cell(ptr)
-                nbytes = max(1, (v.bit_length() + 8) // 8)
-                out.extend(v.to_bytes(nbytes, byteorder="big", signed=True))
+                if -128 < v < 128: out.append(v & 255)
+                else:              out.extend(cell_bytes(v))
 
             elif isinstance(ins, IN):
                 # read bytes up to newline (or EOF)
-                if in_pos >= len(input):
-                    set_cell(ptr, 0)
-                else:
-                    newline_pos = input.find(b"\n", in_pos)
-                    if newline_pos == -1:
-                        chunk = input[in_pos:]
-                        in_pos = len(input)
-                    else:
-                        chunk = input[in_pos:newline_pos]
-                        in_pos = newline_pos + 1
-                    if len(chunk) == 0:
-                        set_cell(ptr, 0)
-                    else:
-                        set_cell(ptr, int.from_bytes(chunk, byteorder="big", signed=True))
+                set_cell(ptr, read() if number is int else number(read()))
 
             elif isinstance(ins, MUL):
                 set_cell(ptr, get_cell(ptr) * get_cell(ptr + ins.k))
@@ -139,8 +379,58 @@ def interpret(program: list, input: bytes = b"") -> bytes:
                     raise ZeroDivisionError("CDIV with divisor 0")
                 set_cell(ptr, get_cell(ptr) // ins.k)
 
+            elif isinstance(ins, AT):
+                ptr += ins.offset
+                exec_block([ins.ins])
+                ptr -= ins.offset
+
+            elif isinstance(ins, COUNTDOWN):
+                n = get_cell(ptr)
+                if n > 0:
+                    for offset, v in countdown_effects(ins, n, lambda o: get_cell(ptr + o)):
+                        set_cell(ptr + offset, v)
+                elif n < 0:
+                    exec_block([ins.loop])
+
+            elif isinstance(ins, MEMO):
+                results = memos.get(id(ins))
+                if results is None:
+                    results = memos[id(ins)] = OrderedDict()
+                key = tuple([get_cell(ptr + o) for o in ins.reads])
+                values = memo_recall(results, key)
+                if values is None:
+                    exec_block([ins.block])
+                    memo_record(results, key, tuple([get_cell(ptr + o) for o in ins.writes]))
+                else:
+                    for o, v in zip(ins.writes, values):
+                        set_cell(ptr + o, v)
+
             else:
                 raise TypeError(f"Unknown instruction: {ins}")
 
     exec_block(program)
     return bytes(out)
+
+# ------------------------ Streaming ------------------------
+
+def stream(program: list, input: bytes | BinaryIO = b"", engine: str = "vm", buffer_size: int | None = 1) -> Iterator[bytes]:
+    # yields output while the program runs: a chunk whenever at least
+    # buffer_size bytes are waiting (1: every OUT), and the rest at the end,
+    # so programs that never halt still produce output in bounded memory
+    if engine == "vm":
+        from interpreter.vm import assemble, execute
+        return execute(assemble(program), input, buffer_size)
+    elif engine == "native":
+        from interpreter.native import compile_program, execute
+        return execute(compile_program(program), input, buffer_size)
+    raise ValueError(f"Engine can't stream: {engine}")
+
+def interpret_to(sink, program: list, input: bytes | BinaryIO = b"", engine: str = "vm", buffer_size: int | None = 1 << 16) -> int:
+    # streams output into sink (a file-like object with write(), or a
+    # callable taking bytes); returns the number of bytes written
+    write = sink.write if hasattr(sink, "write") else sink
+    total = 0
+    for chunk in stream(program, input, engine, buffer_size):
+        write(chunk)
+        total += len(chunk)
+    return total
@@ -0,0 +1,187 @@
+from __future__ import annotations
+import sys
+from collections.abc import Iterator
+from typing import BinaryIO
+from interpreter.analysis import reach
+from interpreter.cache import ProgramCache
+from interpreter.vm import grow
+from interpreter.interpreter import (
+    MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, COUNTDOWN, AT, MEMO, countdown_effects, InputReader,
+    cell_bytes
+)
+
+# ------------------------ Code generation ------------------------
+
+def generate(program: list) -> tuple[str, dict]:
+    # Python source for `def run(input, flush)`, a generator of output chunks
+    # (one whenever at least `flush` bytes are waiting), plus its globals.
+    # The pointer is tracked statically as p + d, so MOVEs only cost code
+    # where a block boundary forces p to catch up. The tape is a list
+    # covering every p + d the code uses; p itself only moves (and the
+    # list only grows) after a LOOP/IFZ body that isn't pointer-balanced,
+    # so programs with a statically bounded window never check bounds.
+    lines = [
+        "def run(input, flush):",
+        "    t = [0] * (HI - LO + 1)",
+        "    p = -LO",
+        "    top = len(t) - 1 - HI",
+        "    read = InputReader(input)",
+        "    o = bytearray()",
+    ]
+    namespace = {"InputReader": InputReader, "countdown_effects": countdown_effects, "grow": grow,
+                 "cell_bytes": cell_bytes}
+    lo = hi = 0
+
+    def const(v) -> str:
+        # big literals go through the namespace: int parsing is size-limited
+        if isinstance(v, int) and abs(v) < 1 << 64:
+            return repr(v)
+        name = f"K{len(namespace)}"
+        namespace[name] = v
+        return name
+
+    def at(d: int) -> str:
+        nonlocal lo, hi
+        lo, hi = min(lo, d), max(hi, d)
+        if d == 0: return "p"
+        if d > 0:  return f"p + {d}"
+        return f"p - {-d}"
+
+    def cell(d: int) -> str:
+        return f"t[{at(d)}]"
+
+    def catch_up(pad: str, shift: int) -> None:
+        lines.append(pad + f"p += {shift}")
+        lines.append(pad + "if p + LO < 0 or p > top:")
+        lines.append(pad + "    p = grow(t, p, LO, HI)")
+        lines.append(pad + "    top = len(t) - 1 - HI")
+
+    def emit_block(block: list, indent: int, d: int) -> int:
+        pad = "    " * indent
+        def emit(line: str) -> None:
+            lines.append(pad + line)
+
+        # consecutive OUTs (MOVEs between them cost no code) are written
+        # together: one bytes() of all the cells when each fits in a
+        # byte, and one flush check
+        outs = []
+        def write_outs() -> None:
+            names = [f"v{j}" for j in range(len(outs))]
+            if len(outs) == 1:
+                emit(f"v0 = {cell(outs[0])}")
+                emit("if -128 < v0 < 128: o.append(v0 & 255)")
+                emit("else:               o += cell_bytes(v0)")
+            else:
+                emit(f"{', '.join(names)} = {', '.join(cell(c) for c in outs)}")
+                emit(f"if {' and '.join(f'-128 < {v} < 128' for v in names)}:")
+                emit(f"    o += bytes(({', '.join(f'{v} & 255' for v in names)}))")
+                emit("else:")
+                emit(f"    o += {' + '.join(f'cell_bytes({v})' for v in names)}")
+            emit("if len(o) >= flush:")
+            emit("    yield bytes(o)")
+            emit("    o.clear()")
+            outs.clear()
+
+        for ins in block:
+            cls = type(ins)
+
+            if cls is OUT or cls is AT and type(ins.ins) is OUT:
+                outs.append(d + ins.offset if cls is AT else d)
+                continue
+            if outs and cls is not MOVE:
+                write_outs()
+
+            if cls is MOVE:
+                d += ins.k
+            elif cls is CADD:
+                emit(f"t[{at(d)}] = {cell(d)} + {const(ins.k)}")
+            elif cls is SET:
+                emit(f"t[{at(d)}] = {const(ins.k)}")
+            elif cls is ADD:
+                emit(f"t[{at(d)}] = {cell(d)} + {cell(d + ins.k)}")
+            elif cls is SUB:
+                emit(f"t[{at(d)}] = {cell(d)} - {cell(d + ins.k)}")
+            elif cls is COPY:
+                emit(f"t[{at(d + ins.k)}] = {cell(d)}")
+            elif cls is SWAP:
+                emit(f"t[{at(d)}], t[{at(d + ins.k)}] = {cell(d + ins.k)}, {cell(d)}")
+            elif cls is MUL:
+                emit(f"t[{at(d)}] = {cell(d)} * {cell(d + ins.k)}")
+            elif cls is CMUL:
+                emit(f"t[{at(d)}] = {cell(d)} * {const(ins.k)}")
+            elif cls is DIV:
+                emit(f"v = {cell(d + ins.k)}")
+                emit("if v == 0: raise ZeroDivisionError('DIV with divisor 0')")
+                emit(f"t[{at(d)}] = {cell(d)} // v")
+            elif cls is CDIV:
+                if ins.k == 0: emit("raise ZeroDivisionError('CDIV with divisor 0')")
+                else:          emit(f"t[{at(d)}] = {cell(d)} // {const(ins.k)}")
+            elif cls is IN:
+                emit(f"t[{at(d)}] = read()")
+
+            elif cls is LOOP or cls is IFZ:
+                emit(f"while {cell(d)}:" if cls is LOOP else f"if not {cell(d)}:")
+                start = len(lines)
+                end = emit_block(ins.body, indent + 1, d)
+                if end != d:           catch_up(pad + "    ", end - d)
+                if len(lines) == start: lines.append(pad + "    pass")
+
+            elif cls is AT:
+                emit_block([ins.ins], indent, d + ins.offset)
+
+            elif cls is MEMO:
+                d = emit_block([ins.block], indent, d)     # run as written: see interpreter.MEMO
+
+            elif cls is COUNTDOWN:
+                a, b = reach(ins)
+                at(d + a), at(d + b)
+                emit(f"c = {cell(d)}")
+                emit("if c > 0:")
+                emit(f"    for e, v in countdown_effects({const(ins)}, c, lambda x, q={at(d)}, t=t: t[q + x]):")
+                emit(f"        t[{at(d)} + e] = v")
+                emit("elif c < 0:")
+                emit_block([ins.loop], indent + 1, d)
+
+            else:
+                raise TypeError(f"Unknown instruction: {ins}")
+
+        if outs:
+            write_outs()
+        return d
+
+    emit_block(program, 1, 0)
+    lines.append("    if o: yield bytes(o)")
+    lines.append("    return")
+    namespace["LO"], namespace["HI"] = lo, hi
+    return "\n".join(lines) + "\n", namespace
+
+
+def compile_program(program: list):
+    # generator function (input, flush) -> output chunks
+    try:
+        source, namespace = generate(program)
+        exec(compile(source, "<intscript>", "exec"), namespace)
+    except (SyntaxError, RecursionError, MemoryError):
+        # nesting deeper than generate() or CPython allows in one function: fall back to bytecode
+        from interpreter.vm import assemble, execute
+        code = assemble(program)
+        return lambda input, flush: execute(code, input, flush)
+    return namespace["run"]
+
+def execute(compiled_program, input: bytes | BinaryIO = b"", buffer_size: int | None = None) -> Iterator[bytes]:
+    return compiled_program(input, buffer_size or sys.maxsize)
+
+# ------------------------ Cache ------------------------
+
+cache = ProgramCache()
+
+def compiled(n: int):
+    # decoded, optimized and compiled once per program integer
+    return cache.native(n)
+
+def run(n: int, input: bytes | BinaryIO = b"") -> bytes:
+    return b"".join(execute(compiled(n), input))
+
+def stream(n: int, input: bytes | BinaryIO = b"", buffer_size: int | None = 1) -> Iterator[bytes]:
+    return execute(compiled(n), input, buffer_size)
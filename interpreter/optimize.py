@@ -0,0 +1,254 @@
+from __future__ import annotations
+from interpreter.interpreter import (
+    MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, COUNTDOWN, AT, MEMO
+)
+from interpreter.analysis import effect
+from interpreter.encode import encoded_size
+
+# ------------------------ Loop idioms ------------------------
+
+def match_countdown(loop: LOOP) -> COUNTDOWN | None:
+    # accepts a flat, pointer-balanced body where the control cell (offset 0)
+    # is only changed by CADDs summing to -1, and every other cell it writes
+    # is either only added to or only multiplied by constants, cells the
+    # body never writes, or the counter
+    ptr = 0
+    counter = 0                 # counter change so far in the iteration
+    adds = {}                   # offset -> [const, cells, shifts]
+    muls = {}
+    reads = set()
+
+    for ins in loop.body:
+        cls = type(ins)
+
+        if cls is MOVE:
+            ptr += ins.k
+            continue
+
+        if ptr == 0:
+            if cls is not CADD: return None
+            counter += ins.k
+            continue
+
+        if cls is CADD:
+            adds.setdefault(ptr, [0, [], []])[0] += ins.k
+
+        elif cls is ADD or cls is SUB:
+            src = ptr + ins.k
+            if src == ptr: return None
+            sign = 1 if cls is ADD else -1
+            terms = adds.setdefault(ptr, [0, [], []])
+            if src == 0: terms[2].append((counter, sign))
+            else:        terms[1].append((src, sign)); reads.add(src)
+
+        elif cls is CMUL:
+            muls.setdefault(ptr, [1, [], []])[0] *= ins.k
+
+        elif cls is MUL:
+            src = ptr + ins.k
+            if src == ptr: return None
+            factors = muls.setdefault(ptr, [1, [], []])
+            if src == 0: factors[2].append((counter, 1))
+            else:        factors[1].append((src, 1)); reads.add(src)
+
+        else:
+            return None
+
+    if ptr != 0 or counter != -1:       return None
+    if adds.keys() & muls.keys():       return None # mixed updates don't have a simple closed form
+    if (adds.keys() | muls.keys()) & reads: return None # sources must not change inside the loop
+
+    def freeze(updates: dict) -> tuple:
+        return tuple((offset, const, tuple(cells), tuple(shifts))
+                     for offset, (const, cells, shifts) in sorted(updates.items()))
+    return COUNTDOWN(freeze(adds), freeze(muls), loop)
+
+
+def recognize_loops(program: list) -> list:
+    out = []
+    for ins in program:
+        if isinstance(ins, LOOP):
+            countdown = match_countdown(ins)
+            if countdown is not None: out.append(countdown)
+            else:                     out.append(LOOP(recognize_loops(ins.body)))
+        elif isinstance(ins, IFZ):
+            out.append(IFZ(recognize_loops(ins.body)))
+        else:
+            out.append(ins)
+    return out
+
+
+# ------------------------ Peephole ------------------------
+
+def local(ins) -> bool:
+    # reads and writes only the current cell, and can't raise
+    return type(ins) in (CADD, SET, CMUL) or (type(ins) is CDIV and ins.k != 0)
+
+def canonical(ins):
+    # rewrite an instruction to a cheaper equivalent with an argument no
+    # longer to encode; None if it does nothing
+    cls = type(ins)
+    if cls in (MOVE, CADD, COPY, SWAP) and ins.k == 0: return None
+    if cls is CMUL and ins.k == 1:  return None
+    if cls is CDIV and ins.k == 1:  return None
+    if cls is CMUL and ins.k == 0:  return SET(0)
+    if cls is CDIV and ins.k == -1: return CMUL(-1)
+    if cls is SUB and ins.k == 0:   return SET(0)
+    return ins
+
+def merge(a, b):
+    # a followed by b, both local to the same cell: one instruction if
+    # possible (None if together they do nothing), otherwise a tuple
+    ta, tb = type(a), type(b)
+    if tb is SET:                   return b
+    if ta is SET and tb is CADD:    return SET(a.k + b.k)
+    if ta is SET and tb is CMUL:    return SET(a.k * b.k)
+    if ta is SET and tb is CDIV:    return SET(a.k // b.k)
+    if ta is CADD and tb is CADD:   return canonical(CADD(a.k + b.k))
+    if ta is CMUL and tb is CMUL:   return canonical(CMUL(a.k * b.k))
+    if ta is CDIV and tb is CDIV and b.k > 0:
+        return canonical(CDIV(a.k * b.k))   # floor(floor(x/a)/b) == floor(x/(a*b)) for b > 0
+    return a, b
+
+def push(out: list, ins) -> None:
+    # append a local instruction, merging it into the ones before it
+    while out and local(out[-1]):
+        merged = merge(out.pop(), ins)
+        if merged is None: return
+        if isinstance(merged, tuple):
+            out.extend(merged)
+            return
+        ins = merged
+    out.append(ins)
+
+def cells(ins) -> set:
+    # cells, relative to the pointer, an instruction reads or writes
+    if type(ins) in (COPY, SWAP, ADD, SUB, MUL, DIV): return {0, ins.k}
+    return {0}
+
+def pure(ins) -> bool:
+    # no effect besides the tape
+    if type(ins) is AT: ins = ins.ins
+    return type(ins) in (MOVE, CADD, SET, CMUL, COPY, SWAP, ADD, SUB, MUL) or local(ins)
+
+
+def peephole(block: list) -> list:
+    # without reordering: merge runs of MOVEs and of local ops on the same
+    # cell, and drop instructions that cancel out. Result stays encodable.
+    out = []
+    for ins in block:
+        if isinstance(ins, (LOOP, IFZ)):
+            ins = type(ins)(peephole(ins.body))
+        else:
+            ins = canonical(ins)
+            if ins is None: continue
+
+        # MOVE(k), SWAP(-k), MOVE(-k) == SWAP(k)
+        if (type(ins) is MOVE and len(out) >= 2 and type(out[-1]) is SWAP
+                and type(out[-2]) is MOVE and out[-2].k == -ins.k == -out[-1].k):
+            out[-2:] = [SWAP(-out[-1].k)]
+            continue
+
+        if type(ins) is MOVE and out and type(out[-1]) is MOVE:
+            merged = canonical(MOVE(out.pop().k + ins.k))
+            if merged is not None: out.append(merged)
+        elif local(ins):
+            push(out, ins)
+        else:
+            out.append(ins)
+    return out
+
+
+def fuse(block: list) -> list:
+    # rebase: track the pointer as an offset within each straight run and
+    # address cells with AT instead of moving, leaving one MOVE per run.
+    # Local ops are buffered per cell and merged until something else
+    # touches that cell.
+    out = []
+    d = 0
+    pending = {}    # cell offset -> local instructions not yet emitted
+
+    def place(offset: int, ins) -> None:
+        out.append(ins if offset == 0 else AT(offset, ins))
+
+    def flush(offsets) -> None:
+        for offset in [o for o in pending if o in offsets]:
+            for ins in pending.pop(offset):
+                place(offset, ins)
+
+    for ins in block:
+        if isinstance(ins, MOVE):
+            d += ins.k
+            continue
+
+        if isinstance(ins, (LOOP, IFZ, COUNTDOWN)):
+            flush(pending.keys())
+            if d != 0: out.append(MOVE(d))
+            d = 0
+            if   isinstance(ins, LOOP): out.append(LOOP(fuse(ins.body)))
+            elif isinstance(ins, IFZ):  out.append(IFZ(fuse(ins.body)))
+            else:                       out.append(ins)
+            continue
+
+        ins = canonical(ins)
+        if ins is None:
+            continue
+        if type(ins) is ADD and ins.k == 0:
+            ins = CMUL(2)       # local, so it can merge; longer to encode, but fuse output is never encoded
+        if local(ins):
+            push(pending.setdefault(d, []), ins)
+            continue
+
+        # SWAP is symmetric: address it from whichever end needs no offset
+        if type(ins) is SWAP and d != 0 and d + ins.k == 0:
+            flush({0, d})
+            out.append(SWAP(d))
+            continue
+
+        flush({d + c for c in cells(ins)})
+        place(d, ins)
+
+    flush(pending.keys())
+    if d != 0: out.append(MOVE(d))
+    return out
+
+
+# ------------------------ Memoization ------------------------
+
+def memoize(block: list) -> list:
+    # wrap every LOOP, and every IFZ with a LOOP in it, that effect() can
+    # describe in a MEMO. Those are the blocks whose cost depends on the
+    # data; a straight-line IFZ body costs less than looking it up.
+    out = []
+    for ins in block:
+        if isinstance(ins, (LOOP, IFZ)):
+            body = type(ins)(memoize(ins.body))
+            e = effect(body) if isinstance(ins, LOOP) or any(isinstance(i, (LOOP, MEMO)) for i in body.body) else None
+            out.append(body if e is None else MEMO(body, *e))
+        else:
+            out.append(ins)
+    return out
+
+
+def optimize(program: list, fused: bool = True, memo: bool = False) -> list:
+    # fused=False keeps to the 15 commands, so the result can be passed to
+    # encode(), and is kept only if it encodes no longer than program;
+    # fused=True also rewrites countdown loops (recognize_loops) and
+    # offset-addressed ops (AT), which only the interpreters accept.
+    # memo=True (with fused) also wraps pure blocks in MEMO (memoize),
+    # which pays off when the same blocks run on the same values again
+    if fused:
+        out = fuse(recognize_loops(program))
+        if memo:
+            out = memoize(out)
+    else:
+        out = peephole(program)
+
+    # nothing after the last side effect is observable
+    while out and pure(out[-1]):
+        out = out[:-1]
+
+    if not fused and encoded_size(out) > encoded_size(program):
+        return program
+    return out
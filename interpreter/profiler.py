@@ -0,0 +1,192 @@
+from __future__ import annotations
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO, TextIO
+from interpreter.interpreter import (
+    MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, COUNTDOWN, AT, MEMO, countdown_effects, InputReader,
+    cell_bytes
+)
+
+# ------------------------ Profile ------------------------
+# Instructions are keyed by their path in the program tree: the index in
+# the program, then the index in each LOOP/IFZ body down to it, so (3, 0)
+# is the first instruction in the body of the 4th instruction. The loop
+# COUNTDOWN falls back to, and the block of a MEMO, is its child 0.
+
+@dataclass
+class Profile:
+    counts: dict = field(default_factory=dict)      # path -> times the instruction ran
+    iterations: dict = field(default_factory=dict)  # path -> times a LOOP/IFZ ran its body
+    times: dict = field(default_factory=dict)       # path -> ns spent in it, body included
+    labels: dict = field(default_factory=dict)      # path -> the instruction, as text
+    steps: int = 0          # instructions executed
+    lo: int = 0             # lowest and highest cell written
+    hi: int = 0
+    peak_bits: int = 0      # largest cell, in bits
+    output_bytes: int = 0
+    elapsed: int = 0        # ns for the whole run
+
+    def self_times(self) -> dict:
+        # path -> ns spent in the instruction itself, children excluded
+        own = dict(self.times)
+        for path, t in self.times.items():
+            if len(path) > 1 and path[:-1] in own:
+                own[path[:-1]] -= t
+        return own
+
+    def report(self, limit: int = 20) -> str:
+        lines = [
+            f"steps          {self.steps}",
+            f"time           {self.elapsed / 1e6:.3f}ms",
+            f"output         {self.output_bytes} bytes",
+            f"tape           cells {self.lo}..{self.hi} ({self.hi - self.lo + 1})",
+            f"peak cell      {self.peak_bits} bits",
+            "",
+            f"{'path':<16} {'instruction':<20} {'count':>10} {'iterations':>10} {'total ms':>10} {'self ms':>10} {'self %':>7}",
+        ]
+        own = self.self_times()
+        total = max(1, sum(own.values()))
+        for path in sorted(own, key=own.get, reverse=True)[:limit]:
+            iterations = self.iterations.get(path, "")
+            lines.append(f"{'.'.join(map(str, path)):<16} {self.labels[path]:<20} {self.counts[path]:>10} "
+                         f"{iterations:>10} {self.times[path] / 1e6:>10.3f} {own[path] / 1e6:>10.3f} "
+                         f"{100 * own[path] / total:>6.1f}%")
+        return "\n".join(lines)
+
+    def collapsed(self) -> str:
+        # one "frame;frame;...;frame ns" line per instruction, self time only,
+        # the format flamegraph.pl and speedscope read
+        own = self.self_times()
+        lines = []
+        for path in sorted(own):
+            frames = [f"{self.labels[path[:d]]}@{'.'.join(map(str, path[:d]))}" for d in range(1, len(path) + 1)]
+            lines.append(f"{';'.join(frames)} {max(0, own[path])}")
+        return "\n".join(lines) + "\n"
+
+    def write_collapsed(self, file: str | TextIO) -> None:
+        if isinstance(file, str):
+            with open(file, "w") as f:
+                f.write(self.collapsed())
+        else:
+            file.write(self.collapsed())
+
+def label(ins) -> str:
+    # no spaces or semicolons, they separate frames in collapsed stacks
+    if isinstance(ins, AT): return f"AT({ins.offset},{label(ins.ins)})"
+    if hasattr(ins, "k"):   return f"{type(ins).__name__}({ins.k})"
+    return type(ins).__name__
+
+# ------------------------ Run ------------------------
+# the tree engine, timing every instruction; interpret(..., profile=Profile())
+
+def run(program: list, input: bytes | BinaryIO, profile: Profile) -> bytes:
+    tape = {}
+    ptr = 0
+    read = InputReader(input)
+    out = bytearray()
+    clock = time.perf_counter_ns
+    counts, iterations, times, labels = profile.counts, profile.iterations, profile.times, profile.labels
+    peak = 0
+
+    def set_cell(i: int, v: int) -> None:
+        nonlocal peak
+        tape[i] = v
+        if v.bit_length() > peak:
+            peak = v.bit_length()
+    def get_cell(i: int) -> int:
+        return tape.get(i, 0)
+
+    def leaf(ins) -> None:
+        # one instruction that isn't a block
+        nonlocal ptr
+        cls = type(ins)
+        if   cls is MOVE: ptr += ins.k
+        elif cls is CADD: set_cell(ptr, get_cell(ptr) + ins.k)
+        elif cls is SET:  set_cell(ptr, ins.k)
+        elif cls is ADD:  set_cell(ptr, get_cell(ptr) + get_cell(ptr + ins.k))
+        elif cls is SUB:  set_cell(ptr, get_cell(ptr) - get_cell(ptr + ins.k))
+        elif cls is COPY: set_cell(ptr + ins.k, get_cell(ptr))
+        elif cls is MUL:  set_cell(ptr, get_cell(ptr) * get_cell(ptr + ins.k))
+        elif cls is CMUL: set_cell(ptr, get_cell(ptr) * ins.k)
+        elif cls is IN:   set_cell(ptr, read())
+
+        elif cls is SWAP:
+            a = get_cell(ptr)
+            b = get_cell(ptr + ins.k)
+            set_cell(ptr, b)
+            set_cell(ptr + ins.k, a)
+
+        elif cls is OUT:
+            v = get_cell(ptr)
+            if -128 < v < 128: out.append(v & 255)
+            else:              out.extend(cell_bytes(v))
+
+        elif cls is DIV:
+            divisor = get_cell(ptr + ins.k)
+            if divisor == 0:
+                raise ZeroDivisionError("DIV with divisor 0")
+            set_cell(ptr, get_cell(ptr) // divisor)
+
+        elif cls is CDIV:
+            if ins.k == 0:
+                raise ZeroDivisionError("CDIV with divisor 0")
+            set_cell(ptr, get_cell(ptr) // ins.k)
+
+        elif cls is AT:
+            ptr += ins.offset
+            leaf(ins.ins)
+            ptr -= ins.offset
+
+        else:
+            raise TypeError(f"Unknown instruction: {ins}")
+
+    def exec_block(block: list, path: tuple) -> None:
+        for j, ins in enumerate(block):
+            key = path + (j,)
+            if key not in labels:
+                labels[key] = label(ins)
+            start = clock()
+            cls = type(ins)
+
+            if cls is LOOP:
+                n = 0
+                while get_cell(ptr) != 0:
+                    exec_block(ins.body, key)
+                    n += 1
+                iterations[key] = iterations.get(key, 0) + n
+
+            elif cls is IFZ:
+                if get_cell(ptr) == 0:
+                    exec_block(ins.body, key)
+                    iterations[key] = iterations.get(key, 0) + 1
+
+            elif cls is COUNTDOWN:
+                n = get_cell(ptr)
+                if n > 0:
+                    for offset, v in countdown_effects(ins, n, lambda o: get_cell(ptr + o)):
+                        set_cell(ptr + offset, v)
+                elif n < 0:
+                    exec_block([ins.loop], key)
+
+            elif cls is MEMO:
+                exec_block([ins.block], key)    # profiled as written
+
+            else:
+                leaf(ins)
+
+            times[key] = times.get(key, 0) + clock() - start
+            counts[key] = counts.get(key, 0) + 1
+
+    start = clock()
+    try:
+        exec_block(program, ())
+    finally:
+        # filled in even when the program raises
+        profile.elapsed += clock() - start
+        profile.steps = sum(counts.values())
+        profile.lo = min(profile.lo, min(tape, default=0))
+        profile.hi = max(profile.hi, max(tape, default=0))
+        profile.peak_bits = max(profile.peak_bits, peak)
+        profile.output_bytes += len(out)
+    return bytes(out)
@@ -0,0 +1,316 @@
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from interpreter.analysis import cell_range, touches
+from interpreter.decode import decode
+from interpreter.interpreter import MOVE, LOOP, IFZ, OUT, IN, freeze
+from interpreter.optimize import optimize, pure
+from interpreter.vm import Machine, assemble, HALTED, OUTPUT
+
+# ------------------------ Search space ------------------------
+# Program integers are tried in increasing order, so the first one that
+# passes every example is the smallest. Whole ranges the header rules
+# out are skipped without decoding: integers under 7 bits, short
+# alphabets (whose header is 21 bits) in integers too short to hold
+# one, and short alphabets with no commands.
+
+HEADER = 7
+SHORT_HEADER = 21
+
+def candidates(start: int, stop: int):
+    n = max(start, 1 << (HEADER - 1))
+    while n < stop:
+        length = n.bit_length()
+        if n >> (length - 2) & 1:
+            if length < SHORT_HEADER:
+                n = 1 << length         # every integer of this length left is short
+                continue
+            if (n >> (length - SHORT_HEADER)) & 0x7FFF == 0:
+                n = ((n >> (length - SHORT_HEADER)) + 1) << (length - SHORT_HEADER)
+                continue
+        yield n
+        n += 1
+
+def commands(program: list) -> set:
+    used = set()
+    for ins in program:
+        used.add(type(ins))
+        if isinstance(ins, (LOOP, IFZ)):
+            used |= commands(ins.body)
+    return used
+
+def stuck(loop: LOOP) -> bool:
+    # a pointer-balanced LOOP that never writes the cell it tests: once
+    # entered it never exits
+    if cell_range([loop]) is None:
+        return False
+    written = set()
+    blocks = [(loop.body, 0)]
+    while blocks:
+        block, p = blocks.pop()
+        for ins in block:
+            cls = type(ins)
+            if   cls is MOVE:               p += ins.k
+            elif cls is LOOP or cls is IFZ: blocks.append((ins.body, p))   # balanced: p is the same after it
+            elif cls is not OUT:            written.update(p + w for w in touches(ins)[1])
+    return 0 not in written
+
+def redundant(program: list) -> bool:
+    # a strictly smaller integer (same header, fewer codes) runs the same:
+    # a leading MOVE (every cell starts at 0), trailing instructions with no
+    # effect besides the tape, or a stuck LOOP (either never entered, so it
+    # can go, or never left, so no example passes)
+    if type(program[0]) is MOVE or pure(program[-1]):
+        return True
+    stack = [program]
+    while stack:
+        for ins in stack.pop():
+            if isinstance(ins, (LOOP, IFZ)):
+                if isinstance(ins, LOOP) and stuck(ins):
+                    return True
+                stack.append(ins.body)
+    return False
+
+# ------------------------ Candidates ------------------------
+
+PASSED, FAILED, UNKNOWN = "passed", "failed", "unknown"
+
+def check(program: list, examples: list, max_steps: int, max_cell_bits: int) -> str:
+    # UNKNOWN when a run hits the step budget or the cell size cap, FAILED
+    # when a run halts (or raises) with the wrong output
+    code = assemble(program)
+    verdict = PASSED
+    for input, expected in examples:
+        machine = Machine(code, input)
+        try:
+            status = machine.run(max_steps, None, max_cell_bits, len(expected) + 1)
+        except ArithmeticError:
+            return FAILED
+        if status == HALTED:
+            if machine.take_output() != expected: return FAILED
+        elif status == OUTPUT:
+            return FAILED   # more output than expected
+        else:
+            verdict = UNKNOWN
+    return verdict
+
+# programs known to fail the current examples, as optimize(fused=False)
+# forms: a candidate with the same form fails too
+MAX_FAILED = 1 << 16
+failed = {}     # digest of the examples -> forms
+
+def known_failures(key: str) -> set:
+    if key not in failed:
+        failed.clear()
+        failed[key] = set()
+    return failed[key]
+
+def search_range(start: int, stop: int, examples: list, max_steps: int, max_cell_bits: int) -> tuple:
+    # (smallest passing integer in start..stop-1 or None, candidates run, candidates pruned)
+    known = known_failures(digest(examples, max_steps, max_cell_bits))
+    needs_out = any(expected for _, expected in examples)
+    needs_in = len({expected for _, expected in examples}) > 1
+    tested = pruned = 0
+
+    for n in candidates(start, stop):
+        try:
+            program = decode(n)
+        except ValueError:
+            pruned += 1
+            continue
+
+        used = commands(program)
+        if (needs_out and OUT not in used) or (needs_in and IN not in used) or (program and redundant(program)):
+            pruned += 1
+            continue
+
+        try:
+            key = freeze(optimize(program, fused=False))
+        except RecursionError:
+            key = None
+        if key in known:
+            pruned += 1
+            continue
+
+        tested += 1
+        verdict = check(program, examples, max_steps, max_cell_bits)
+        if verdict == PASSED:
+            return n, tested, pruned
+        if verdict == FAILED and key is not None:
+            if len(known) >= MAX_FAILED:
+                known.clear()
+            known.add(key)
+    return None, tested, pruned
+
+# ------------------------ Search ------------------------
+
+@dataclass
+class SearchResult:
+    program: int | None     # smallest passing integer, None if there's none below the limit
+    next: int               # every integer below this was searched
+    tested: int             # candidates run on the examples
+    pruned: int             # candidates ruled out without running
+
+CHECKPOINT_EVERY = 10.0     # seconds between checkpoint writes
+
+def digest(examples: list, max_steps: int, max_cell_bits: int) -> str:
+    h = hashlib.sha256(repr((max_steps, max_cell_bits)).encode())
+    for input, expected in examples:
+        h.update(len(input).to_bytes(8, "big") + input + len(expected).to_bytes(8, "big") + expected)
+    return h.hexdigest()
+
+def load_checkpoint(path: str, key: str) -> SearchResult | None:
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state["digest"] != key:
+        raise ValueError(f"Checkpoint is for a different search: {path}")
+    return SearchResult(None if state["program"] is None else int(state["program"]),
+                        int(state["next"]), state["tested"], state["pruned"])
+
+def save_checkpoint(path: str, key: str, result: SearchResult) -> None:
+    # integers as strings: JSON readers elsewhere may not take big ones
+    state = {"digest": key, "program": None if result.program is None else str(result.program),
+             "next": str(result.next), "tested": result.tested, "pruned": result.pruned}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+def search(examples: list, limit: int | None = None, max_steps: int = 10_000, max_cell_bits: int | None = None,
+           workers: int | None = None, chunk_size: int = 1 << 14, checkpoint: str | None = None) -> SearchResult:
+    # the smallest program integer below limit (None: no limit, search until
+    # found) whose program prints `expected` for every (input, expected) in
+    # examples within max_steps instructions. With a checkpoint file, the
+    # search resumes from it and records its progress there.
+    examples = [(bytes(input), bytes(expected)) for input, expected in examples]
+    if max_cell_bits is None:
+        # room for anything the examples read or print, with some to spare
+        max_cell_bits = 64 + 8 * max((max(len(i), len(o)) for i, o in examples), default=0)
+    key = digest(examples, max_steps, max_cell_bits)
+
+    result = SearchResult(None, 1 << (HEADER - 1), 0, 0)
+    if checkpoint is not None:
+        result = load_checkpoint(checkpoint, key) or result
+        if result.program is not None:
+            return result
+    last_save = time.monotonic()
+
+    def record(found: int | None, tested: int, pruned: int, stop: int) -> None:
+        nonlocal last_save
+        result.program, result.next = found, stop
+        result.tested += tested
+        result.pruned += pruned
+        if checkpoint is not None and (found is not None or time.monotonic() - last_save >= CHECKPOINT_EVERY):
+            save_checkpoint(checkpoint, key, result)
+            last_save = time.monotonic()
+
+    def chunks():
+        start = result.next
+        while limit is None or start < limit:
+            stop = start + chunk_size if limit is None else min(start + chunk_size, limit)
+            yield start, stop
+            start = stop
+
+    try:
+        if workers == 1:
+            for start, stop in chunks():
+                found, tested, pruned = search_range(start, stop, examples, max_steps, max_cell_bits)
+                record(found, tested, pruned, stop if found is None else found)
+                if found is not None:
+                    break
+            return result
+
+        # chunks finish in any order; progress is recorded for the finished
+        # prefix, so the first passing integer found there is the smallest
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            pending = {}        # future -> (start, stop)
+            done_chunks = {}    # start -> (stop, found, tested, pruned)
+            ranges = chunks()
+            try:
+                while True:
+                    while len(pending) < 2 * workers:
+                        r = next(ranges, None)
+                        if r is None: break
+                        pending[pool.submit(search_range, *r, examples, max_steps, max_cell_bits)] = r
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        start, stop = pending.pop(future)
+                        done_chunks[start] = (stop, *future.result())
+
+                    while result.next in done_chunks:
+                        stop, found, tested, pruned = done_chunks.pop(result.next)
+                        record(found, tested, pruned, stop if found is None else found)
+                        if found is not None:
+                            return result
+            finally:
+                for future in pending:
+                    future.cancel()
+        return result
+    finally:
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, key, result)
+
+def superoptimize(program, inputs: list, max_steps: int | None = None, **options) -> SearchResult:
+    # search for a smaller program integer that prints what `program` (a
+    # program integer or instruction list, which must halt on every input)
+    # prints; if there's none, result.program is the reference's integer
+    from interpreter.encode import encode
+    n = program if isinstance(program, int) else encode(program)
+    code = assemble(decode(n))
+
+    examples = []
+    steps = 0
+    for input in inputs:
+        machine = Machine(code, input)
+        machine.run()
+        examples.append((bytes(input), machine.take_output()))
+        steps = max(steps, machine.steps)
+
+    result = search(examples, n, max_steps or max(1000, 4 * steps), **options)
+    if result.program is None:
+        result.program = n
+    return result
+
+# ------------------------ CLI ------------------------
+
+def main(argv: list | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m interpreter.search",
+                                     description="Find the smallest IntScript program integer for a behaviour.")
+    parser.add_argument("--program", default=None, help="reference program integer to shrink")
+    parser.add_argument("--input", action="append", default=[], help="input (hex) to run the reference on, repeatable")
+    parser.add_argument("--example", action="append", default=[], help="INPUT:OUTPUT (hex), repeatable, without --program")
+    parser.add_argument("--limit", default=None, help="search integers below this")
+    parser.add_argument("--max-steps", type=int, default=None, help="instruction budget per candidate run")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--checkpoint", default=None, help="file to resume from and record progress in")
+    args = parser.parse_args(argv)
+    sys.set_int_max_str_digits(0)
+
+    options = {"workers": args.workers, "checkpoint": args.checkpoint}
+    if args.program is not None:
+        inputs = [bytes.fromhex(i) for i in args.input] or [b""]
+        result = superoptimize(int(args.program), inputs, args.max_steps, **options)
+    else:
+        examples = [tuple(bytes.fromhex(part) for part in e.split(":")) for e in args.example]
+        limit = None if args.limit is None else int(args.limit)
+        result = search(examples, limit, args.max_steps or 10_000, **options)
+    print(json.dumps({"program": None if result.program is None else str(result.program),
+                      "next": str(result.next), "tested": result.tested, "pruned": result.pruned}))
+
+
+if __name__ == "__main__":
+    main()
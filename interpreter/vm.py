@@ -0,0 +1,471 @@
+from __future__ import annotations
+import sys
+import time
+from collections.abc import Iterator
+from operator import methodcaller
+from dataclasses import dataclass, field
+from typing import BinaryIO
+from interpreter.analysis import extent, cell_range
+from interpreter.interpreter import (
+    MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
+    IFZ, OUT, IN, MUL, CMUL, DIV, CDIV, COUNTDOWN, AT, MEMO, countdown_effects, countdown_bits, InputReader,
+    InputPending, cell_bytes, number_type
+)
+
+# ------------------------ Opcodes ------------------------
+
+# numbered roughly by how often they run in hot loops, which is also
+# the order run() tests them in
+OP_MOVE = 0
+OP_CADD = 1
+OP_JZ   = 2   # jump to arg if tape[ptr] == 0
+OP_JNZ  = 3   # jump to arg if tape[ptr] != 0
+OP_ADD  = 4
+OP_SUB  = 5
+OP_COPY = 6
+OP_SWAP = 7
+OP_MUL  = 8
+OP_SET  = 9
+OP_CMUL = 10
+OP_OUT  = 11
+OP_IN   = 12
+OP_DIV  = 13
+OP_CDIV = 14
+OP_COUNTDOWN = 15  # arg is the COUNTDOWN; its loop follows as ordinary code
+OP_MOVE_GROW = 16  # MOVE that may leave the allocated tape (unbounded programs only)
+
+# superinstructions: the instruction at pc fused with the one(s) after it,
+# whose arguments they read from pc+1 (and pc+2)
+OP_MOVE_CADD = 17
+OP_CADD_MOVE = 18
+OP_MOVE_JNZ  = 19
+OP_CADD_JNZ  = 20
+OP_CADD_CADD = 21
+OP_MOVE_CADD_MOVE = 22
+
+# instruction class -> opcode, for everything that isn't a block
+OPCODES = {
+    MOVE: OP_MOVE, CADD: OP_CADD, ADD: OP_ADD, SUB: OP_SUB, COPY: OP_COPY,
+    SWAP: OP_SWAP, MUL: OP_MUL, SET: OP_SET, CMUL: OP_CMUL, OUT: OP_OUT,
+    IN: OP_IN, DIV: OP_DIV, CDIV: OP_CDIV,
+}
+
+# the most frequent sequences in hot loops, as written (MOVE(1), CADD(k),
+# MOVE(-1) ...) and after optimize() (CADD(k) on two cells, CADD(-1) then
+# the loop test ...); longest first
+SUPERINSTRUCTIONS = {
+    (OP_MOVE, OP_CADD, OP_MOVE): OP_MOVE_CADD_MOVE,
+    (OP_MOVE, OP_CADD): OP_MOVE_CADD,
+    (OP_CADD, OP_MOVE): OP_CADD_MOVE,
+    (OP_MOVE, OP_JNZ):  OP_MOVE_JNZ,
+    (OP_CADD, OP_JNZ):  OP_CADD_JNZ,
+    (OP_CADD, OP_CADD): OP_CADD_CADD,
+}
+
+# ------------------------ Compile ------------------------
+
+@dataclass
+class Bytecode:
+    ops:  list = field(default_factory=list)  # opcode per instruction
+    fused: list = field(default_factory=list) # ops, with superinstructions where a sequence starts
+    args: list = field(default_factory=list)  # argument k, jump target for OP_JZ/OP_JNZ, or instruction
+    offs: list = field(default_factory=list)  # cell the instruction works on, relative to the pointer (AT)
+    runs: list = field(default_factory=list)  # instructions from here through the next jump (or the end)
+    lo: int = 0         # tape window relative to the start cell: exact if bounded,
+    hi: int = 0         # otherwise the reach of a single instruction from the pointer
+    bounded: bool = True
+
+    def emit(self, op: int, arg: int = 0, off: int = 0) -> int:
+        self.ops.append(op)
+        self.args.append(arg)
+        self.offs.append(off)
+        return len(self.ops) - 1
+
+def assemble(program: list) -> Bytecode:
+    code = Bytecode()
+
+    window = cell_range(program)
+    if window is None:
+        code.bounded = False
+        code.lo, code.hi = extent(program)
+    else:
+        code.lo, code.hi = window
+    move = OP_MOVE if code.bounded else OP_MOVE_GROW
+
+    # blocks are emitted with an explicit stack instead of recursion, so
+    # nesting depth isn't limited by Python's recursion limit
+    stack = [(iter(program), None, None)]  # (rest of a block, its LOOP/IFZ's jump, LOOP/IFZ)
+    while stack:
+        block, head, kind = stack[-1]
+        for ins in block:
+            cls = type(ins)
+
+            if cls is LOOP:
+                # JZ end; body; JNZ start
+                stack.append((iter(ins.body), code.emit(OP_JZ), LOOP))
+                break
+
+            elif cls is IFZ:
+                # JNZ end; body
+                stack.append((iter(ins.body), code.emit(OP_JNZ), IFZ))
+                break
+
+            elif cls is COUNTDOWN:
+                # leaves the counter at 0 unless it was negative, in which
+                # case the compiled loop right after it takes over
+                code.emit(OP_COUNTDOWN, ins)
+                stack.append((iter([ins.loop]), None, None))
+                break
+
+            elif cls is MEMO:
+                stack.append((iter([ins.block]), None, None))   # run as written: see interpreter.MEMO
+                break
+
+            elif cls is MOVE:
+                code.emit(move, ins.k)
+
+            elif cls in OPCODES:
+                code.emit(OPCODES[cls], getattr(ins, "k", 0))
+
+            elif cls is AT and type(ins.ins) in OPCODES and type(ins.ins) is not MOVE:
+                code.emit(OPCODES[type(ins.ins)], getattr(ins.ins, "k", 0), ins.offset)
+
+            else:
+                raise TypeError(f"Unknown instruction: {ins}")
+        else:
+            stack.pop()
+            if kind is LOOP:
+                code.emit(OP_JNZ, head + 1)
+            if head is not None:
+                code.args[head] = len(code.ops)
+
+    # straight-line runs, for counting executed instructions per jump
+    code.runs = [0] * (len(code.ops) + 1)
+    for x in range(len(code.ops) - 1, -1, -1):
+        code.runs[x] = 1 if code.ops[x] in (OP_JZ, OP_JNZ) else 1 + code.runs[x + 1]
+
+    code.fused = superinstructions(code.ops)
+    return code
+
+def superinstructions(ops: list) -> list:
+    # every instruction that starts a sequence in SUPERINSTRUCTIONS is
+    # replaced by the superinstruction, and the rest of the sequence is
+    # left in place: a superinstruction at x continues at x + its length,
+    # so jumps into the middle of one, step counts (runs) and stopping
+    # partway through a run (which uses plain ops) work as before
+    fused = list(ops)
+    for x in range(len(ops)):
+        for sequence, op in SUPERINSTRUCTIONS.items():
+            if tuple(ops[x:x + len(sequence)]) == sequence:
+                fused[x] = op
+                break
+    return fused
+
+# ------------------------ Run ------------------------
+
+def grow(tape: list, ptr: int, lo: int, hi: int) -> int:
+    # make tape[ptr + lo : ptr + hi + 1] valid, at least doubling the tape
+    # when it has to grow; returns the pointer's new index
+    if ptr + lo < 0:
+        extra = max(len(tape), -(ptr + lo))
+        tape[:0] = [0] * extra
+        ptr += extra
+    if ptr + hi >= len(tape):
+        tape.extend([0] * max(len(tape), ptr + hi + 1 - len(tape)))
+    return ptr
+
+# ------------------------ Machine ------------------------
+# Machine.run executes until the program halts or a limit is hit, and
+# returns why it stopped; calling it again carries on from there.
+# Instructions are counted a straight-line run at a time, when a jump
+# picks the next run, and the other limits are checked between runs
+# every CHECK_EVERY or so instructions. The exceptions are MUL/CMUL/
+# COUNTDOWN/IN results, which are checked against the cell size cap as
+# they're written (ADD/SUB grow a cell by at most a bit per step).
+# A COUNTDOWN's closed form counts as one instruction and isn't
+# interrupted, so with any limit set it only runs when the iterations it
+# replaces fit in what's left of max_steps and the cells it writes fit
+# under the cap (or COUNTDOWN_BITS, with a timeout); otherwise the loop
+# after it runs them, checked like any other code.
+
+HALTED    = "halted"      # ran off the end of the program
+OUTPUT    = "output"      # at least buffer_size bytes of output are waiting
+STEPS     = "steps"       # max_steps instructions executed
+TIMEOUT   = "timeout"     # timeout seconds passed
+CELL_SIZE = "cell_size"   # a cell grew past max_cell_bits bits
+INPUT     = "input"       # an IN's line hasn't arrived yet (InputPending); pc is at the IN
+
+CHECK_EVERY = 4096
+COUNTDOWN_BITS = 1 << 20    # largest cell a closed form may build with a timeout
+
+@dataclass
+class Snapshot:
+    # everything needed to resume a Machine on the same Bytecode; picklable
+    tape: list
+    ptr: int
+    pc: int
+    in_pos: int     # bytes of input consumed
+    out: bytes      # output not yet taken
+    steps: int
+
+class Machine:
+    def __init__(self, code: Bytecode, input: bytes | BinaryIO = b"", snapshot: Snapshot | None = None,
+                 arithmetic: str = "int") -> None:
+        # resuming from a snapshot: a buffer input is read from where the
+        # snapshot left off, a stream from wherever it is now
+        self.code = code
+        self.number = number_type(arithmetic)
+        self.args = code.args
+        if self.number is not int:
+            # cells start out as mpz: SET constants here, IN values as they're read
+            self.args = [self.number(k) if op == OP_SET else k for op, k in zip(code.ops, code.args)]
+        if snapshot is None:
+            # cell i lives at tape[i - lo]; a bounded program never leaves the
+            # preallocated window, an unbounded one grows it on OP_MOVE_GROW
+            self.tape = [self.number(0)] * (code.hi - code.lo + 1)
+            self.ptr = -code.lo
+            self.pc = 0
+            self.read = InputReader(input)
+            self.out = bytearray()
+            self.steps = 0              # instructions executed so far
+        else:
+            self.tape = list(snapshot.tape)
+            self.ptr = snapshot.ptr
+            self.pc = snapshot.pc
+            self.read = InputReader(input, snapshot.in_pos)
+            self.out = bytearray(snapshot.out)
+            self.steps = snapshot.steps
+
+    @property
+    def halted(self) -> bool:
+        return self.pc >= len(self.code.ops)
+
+    def snapshot(self) -> Snapshot:
+        return Snapshot(list(self.tape), self.ptr, self.pc, self.read.pos, bytes(self.out), self.steps)
+
+    def take_output(self) -> bytes:
+        out = bytes(self.out)
+        self.out.clear()
+        return out
+
+    def run(self, max_steps: int | None = None, timeout: float | None = None,
+            max_cell_bits: int | None = None, buffer_size: int | None = None) -> str:
+        # limits apply to this call: at most max_steps more instructions,
+        # timeout more seconds
+        code = self.code
+        number = self.number
+        args = self.args
+        offs = code.offs
+        runs = code.runs
+        n = len(code.ops)
+        lo, hi = code.lo, code.hi
+        tape = self.tape
+        ptr = self.ptr
+        top = len(tape) - 1 - hi     # highest pointer index before the tape must grow
+        pc = self.pc
+        read = self.read
+        out = self.out
+        bit_length = int.bit_length
+        if number is not int:
+            read = lambda reader=read: number(reader())
+            bit_length = methodcaller("bit_length")
+
+        flush = buffer_size or sys.maxsize
+        cap = max_cell_bits or 0
+        deadline = None if timeout is None else time.monotonic() + timeout
+        every = CHECK_EVERY if deadline is not None or cap else 1 << 24   # small ints count faster
+        limited = max_steps is not None or deadline is not None or cap
+        max_bits = cap or (COUNTDOWN_BITS if deadline is not None else None)
+        used = 0            # instructions executed in earlier batches
+        status = None
+
+        while status is None:
+            # between runs: check the limits, then charge the run at pc
+            # to a new batch of fuel
+            if pc >= n:
+                status = HALTED
+                break
+            if max_steps is not None and used >= max_steps:
+                status = STEPS
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                status = TIMEOUT
+                break
+            if cap and max(map(bit_length, tape)) > cap:
+                status = CELL_SIZE
+                break
+
+            batch = every if max_steps is None else min(max_steps - used, every)
+            if max_steps is not None and runs[pc] > batch:
+                end = pc + batch    # the batch ends partway through this run
+                fuel = 0
+                ops = code.ops      # one instruction at a time, to stop exactly at end
+            else:
+                end = n
+                fuel = batch - runs[pc]
+                ops = code.fused
+
+            # opcodes are compared as literals: a global OP_* lookup per test
+            # costs more than the test itself
+            while pc < end:
+                op = ops[pc]
+                k = args[pc]
+                i = ptr + offs[pc]
+                pc += 1
+
+                if op > 16:
+                    # superinstructions, tested apart so they add one test to the others
+                    if op == 17:  # MOVE_CADD
+                        ptr += k
+                        i = ptr + offs[pc]
+                        tape[i] = tape[i] + args[pc]
+                        pc += 1
+
+                    elif op == 18:  # CADD_MOVE
+                        tape[i] = tape[i] + k
+                        ptr += args[pc]
+                        pc += 1
+
+                    elif op == 19:  # MOVE_JNZ
+                        ptr += k
+                        if tape[ptr + offs[pc]] != 0: pc = args[pc]
+                        else:                         pc += 1
+                        fuel -= runs[pc]
+                        if fuel < 0: break
+
+                    elif op == 20:  # CADD_JNZ
+                        tape[i] = tape[i] + k
+                        if tape[ptr + offs[pc]] != 0: pc = args[pc]
+                        else:                         pc += 1
+                        fuel -= runs[pc]
+                        if fuel < 0: break
+
+                    elif op == 21:  # CADD_CADD
+                        tape[i] = tape[i] + k
+                        i = ptr + offs[pc]
+                        tape[i] = tape[i] + args[pc]
+                        pc += 1
+
+                    elif op == 22:  # MOVE_CADD_MOVE
+                        ptr += k
+                        i = ptr + offs[pc]
+                        tape[i] = tape[i] + args[pc]
+                        ptr += args[pc + 1]
+                        pc += 2
+
+                elif op == 0:  # MOVE
+                    ptr += k
+
+                elif op == 16:  # MOVE_GROW
+                    ptr += k
+                    if ptr + lo < 0 or ptr > top:
+                        ptr = grow(tape, ptr, lo, hi)
+                        top = len(tape) - 1 - hi
+
+                elif op == 1:  # CADD
+                    tape[i] = tape[i] + k
+
+                elif op == 2:  # JZ
+                    if tape[i] == 0: pc = k
+                    fuel -= runs[pc]
+                    if fuel < 0: break
+
+                elif op == 3:  # JNZ
+                    if tape[i] != 0: pc = k
+                    fuel -= runs[pc]
+                    if fuel < 0: break
+
+                elif op == 4:  # ADD
+                    tape[i] = tape[i] + tape[i + k]
+
+                elif op == 5:  # SUB
+                    tape[i] = tape[i] - tape[i + k]
+
+                elif op == 6:  # COPY
+                    tape[i + k] = tape[i]
+
+                elif op == 7:  # SWAP
+                    a = tape[i]
+                    tape[i] = tape[i + k]
+                    tape[i + k] = a
+
+                elif op == 8:  # MUL
+                    tape[i] = tape[i] * tape[i + k]
+                    if cap and tape[i].bit_length() > cap:
+                        status = CELL_SIZE
+                        break
+
+                elif op == 9:  # SET
+                    tape[i] = k
+
+                elif op == 10:  # CMUL
+                    tape[i] = tape[i] * k
+                    if cap and tape[i].bit_length() > cap:
+                        status = CELL_SIZE
+                        break
+
+                elif op == 11:  # OUT
+                    v = tape[i]
+                    if -128 < v < 128: out.append(v & 255)
+                    else:              out.extend(cell_bytes(v))
+                    if len(out) >= flush:
+                        status = OUTPUT
+                        break
+
+                elif op == 12:  # IN
+                    try:
+                        tape[i] = read()
+                    except InputPending:
+                        pc -= 1     # not executed: run it again once the line is there
+                        status = INPUT
+                        break
+                    if cap and tape[i].bit_length() > cap:
+                        status = CELL_SIZE
+                        break
+
+                elif op == 13:  # DIV
+                    divisor = tape[i + k]
+                    if divisor == 0:
+                        raise ZeroDivisionError("DIV with divisor 0")
+                    tape[i] = tape[i] // divisor
+
+                elif op == 14:  # CDIV
+                    if k == 0:
+                        raise ZeroDivisionError("CDIV with divisor 0")
+                    tape[i] = tape[i] // k
+
+                elif op == 15:  # COUNTDOWN
+                    c = tape[i]
+                    if c > 0:
+                        cell = lambda o, p=i, t=tape: t[p + o]
+                        if limited and (
+                                max_steps is not None and c * (len(k.loop.body) + 1) > max_steps - used
+                                or max_bits is not None and countdown_bits(k, c, cell) > max_bits):
+                            continue    # too big for the limits: the loop after it runs it (see above)
+                        for offset, v in countdown_effects(k, c, cell):
+                            tape[i + offset] = v
+                            if cap and v.bit_length() > cap:
+                                status = CELL_SIZE
+                        if status is not None:
+                            break
+
+            # fuel was charged for whole runs: give back what's left of this one
+            used += batch - fuel - (min(runs[pc], end - pc) if pc < end else 0)
+
+        self.ptr = ptr
+        self.pc = pc
+        self.steps += used
+        return status
+
+def run(code: Bytecode, input: bytes | BinaryIO = b"", arithmetic: str = "int") -> bytes:
+    return b"".join(execute(code, input, arithmetic=arithmetic))
+
+def execute(code: Bytecode, input: bytes | BinaryIO = b"", buffer_size: int | None = None,
+            arithmetic: str = "int") -> Iterator[bytes]:
+    # yields output as it's produced: whenever at least buffer_size bytes
+    # are waiting (None: only once, at the end)
+    machine = Machine(code, input, arithmetic=arithmetic)
+    while machine.run(buffer_size=buffer_size) == OUTPUT:
+        yield machine.take_output()
+    if machine.out:
+        yield machine.take_output()
@@ -1,12 +1,32 @@
 from __future__ import annotations
 
-from interpreter.encode      import encode
-from interpreter.decode      import decode
+import asyncio
+import io
+import json
+import mmap
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from interpreter.aio         import execute as session
+from interpreter.batch       import ERROR, Job, run_batch
+from interpreter.cache       import DISK_VERSION, CacheStats, ProgramCache, footprint
+from interpreter.container   import dumps, loads
+import interpreter.encode
+from interpreter.encode      import encode, shortest_configs, statistics
+from interpreter.decode      import decode, decode_lazy
 from interpreter.interpreter import (
-    interpret,
+    interpret, freeze, InputReader,
     MOVE, CADD, SET, ADD, SUB, COPY, SWAP, LOOP,
     IFZ, OUT, IN, MUL, CMUL, DIV, CDIV,
 )
+from interpreter.optimize    import optimize
+from interpreter.search      import PASSED, search, check as search_check
+from interpreter.vm          import Machine, assemble, execute, HALTED, STEPS, TIMEOUT, CELL_SIZE
 
 # ------------------------ Tests ------------------------
 
@@ -190,8 +210,427 @@ def test_and_compute_compactness() -> int:
     print("AVERAGE:        " + str(total // len(programs))) # average
     print("-" * 80)
 
+# ------------------------ Checks ------------------------
+# python test.py check: runs every check, prints what fails, exits 1 if anything did
+
+def lines(*values: int) -> bytes:
+    # IN reads one signed big-endian integer per line
+    return b"\n".join(v.to_bytes(max(1, (v.bit_length() + 8) // 8), "big", signed=True) for v in values)
+
+# (program, input, expected output) for every program above; the inputs keep runs short
+CASES = {
+    "HELLO_WORLD":   (HELLO_WORLD,   b"",                b"Hello, World!"),
+    "FACTORIAL":     (FACTORIAL,     lines(20),          lines(2432902008176640000)),
+    "SQRT":          (SQRT,          lines(144),         lines(12)),
+    "FIBONACCI":     (FIBONACCI,     lines(90),          lines(2880067194370816120)),
+    "GCD":           (GCD,           lines(1071, 462),   lines(21)),
+    "POWER":         (POWER,         lines(3, 40),       lines(3 ** 40)),
+    "TRIANGULAR":    (TRIANGULAR,    lines(10 ** 30),    lines(10 ** 30 * (10 ** 30 + 1) // 2)),
+    "COLLATZ":       (COLLATZ,       lines(27),          lines(111)),
+    "TRUTH_MACHINE": (TRUTH_MACHINE, lines(0),           b"\x00"),
+    # OUT writes max(1, (bit_length + 8) // 8) bytes: -128 takes two
+    "OUTPUT_SIZES":  ([SET(-129), OUT(), CADD(1), OUT(), CADD(1), OUT(), SET(127), OUT(), CADD(1), OUT()],
+                      b"", b"\xff\x7f" + b"\xff\x80" + b"\x81" + b"\x7f" + b"\x00\x80"),
+}
+
+def materialize(block) -> list:
+    # a decode_lazy program as the lists decode() gives
+    return [type(ins)(materialize(ins.body)) if isinstance(ins, (LOOP, IFZ)) else ins for ins in block]
+
+def check_engines() -> int:
+    # every engine, on the program as written and optimized, gives the expected output
+    errors = 0
+    for name, (program, input, expected) in CASES.items():
+        variants = {
+            "as written":  program,
+            "optimized":   optimize(program),
+            "peephole":    optimize(program, fused=False),
+            "memoized":    optimize(program, memo=True),
+        }
+        for variant, code in variants.items():
+            for engine in ("tree", "vm", "native"):
+                out = interpret(code, input, engine)
+                if out != expected:
+                    print(f"Error: {name} ({variant}, {engine}) printed {out!r}, expected {expected!r}")
+                    errors += 1
+        out = interpret(program, input, "vm", arithmetic="gmpy2")
+        if out != expected:
+            print(f"Error: {name} (gmpy2) printed {out!r}, expected {expected!r}")
+            errors += 1
+    return errors
+
+def check_sharing() -> int:
+    # a frozen program is safe to share: one memoized program run from
+    # many threads at once gives every run the expected output
+    errors = 0
+    for name, (program, input, expected) in CASES.items():
+        shared = freeze(optimize(program, memo=True))
+        with ThreadPoolExecutor(8) as pool:
+            outs = list(pool.map(lambda _: interpret(shared, input), range(32)))
+        if any(out != expected for out in outs):
+            print(f"Error: {name} (memoized, shared between threads) printed the wrong output")
+            errors += 1
+    return errors
+
+# integers that aren't encode() output decode as they always have: a code
+# cut off by the end of the bits is dropped in the extended alphabet, an
+# error in the normal one; an argument's remainder cut off is read short
+DECODED = {
+    1106519:   [SET(-5)],
+    2190777:   [SWAP(2), IFZ([])],
+    270951694: [DIV(1), MUL(0), MOVE(-1)],
+    0b1000:    [],
+    0b1000000_0110: [],
+    0b1010000_001:  None,   # None: raises ValueError
+    0b101:     None,
+    1:         None,
+}
+
+def check_encoding() -> int:
+    # decode(encode(p)) == p, and decode_lazy and the container give the same program
+    errors = 0
+    for name, (program, input, expected) in CASES.items():
+        n = encode(program)
+        if decode(n) != program:
+            print(f"Error: {name} decoded incorrectly")
+            errors += 1
+        if materialize(decode_lazy(n)) != program:
+            print(f"Error: {name} decoded lazily incorrectly")
+            errors += 1
+        if interpret(decode_lazy(n), input) != expected:
+            print(f"Error: {name} ran incorrectly from decode_lazy")
+            errors += 1
+        if loads(dumps(n)) != n:
+            print(f"Error: {name} didn't survive the container format")
+            errors += 1
+
+    for n, program in DECODED.items():
+        for name, f in (("decode", decode), ("decode_lazy", lambda n: materialize(decode_lazy(n)))):
+            try:
+                decoded = f(n)
+            except ValueError:
+                decoded = None
+            if decoded != program:
+                print(f"Error: {name}({n}) gave {decoded}, expected {program}")
+                errors += 1
+
+    # optimize(fused=False) output is for encoding: it must never encode longer
+    for name, program in [*((name, case[0]) for name, case in CASES.items()), ("ADD_ZERO", [IN(), ADD(0), OUT()])]:
+        before, after = encode(program), encode(optimize(program, fused=False))
+        if after.bit_length() > before.bit_length():
+            print(f"Error: {name} encodes to {after.bit_length()} bits optimized, {before.bit_length()} as written")
+            errors += 1
+    return errors
+
+def check_parallel_encoding() -> int:
+    # encode(workers=) gives what encode() does, for winners in each
+    # alphabet and with LOOP/IFZ bodies cut across pieces; the gates are
+    # lowered so it runs on tiny programs and a single CPU
+    errors = 0
+    args = [MOVE, CADD, COPY, SET, MUL, DIV, ADD, SUB, SWAP, CMUL, CDIV]
+    normal = [cls(k) for k in (5, -6, 7) for cls in args] + [IN(), OUT(), IFZ([OUT()]), LOOP([IN()])]
+    extended = [cls(k) for k in (1, -1) for cls in (MOVE, CADD, ADD, SUB)] * 3 + [
+        COPY(2), SWAP(1), SET(3), MUL(2), DIV(2), CMUL(3), CDIV(2), IN(), OUT(), IFZ([OUT()]), LOOP([IN()])]
+    short = [CADD(1)] * 20 + [LOOP([MOVE(1), CADD(-2)] * 12)] + [MOVE(-1), CADD(3)] * 5
+    programs = {
+        **{name: case[0] for name, case in CASES.items()},
+        "normal": normal, "nested normal": [LOOP(normal + [IFZ(normal)]), OUT()],
+        "extended": extended, "nested extended": [IFZ(extended * 2), LOOP(extended)],
+        "short": short, "nested short": [LOOP(short + [IFZ(short)]), CADD(1)],
+    }
+
+    module = interpreter.encode
+    gates = module.PIECE, module.PARALLEL_MIN, module.MIN_WORKERS
+    module.PIECE, module.PARALLEL_MIN, module.MIN_WORKERS = 8, 16, 1
+    winners = set()
+    try:
+        for name, program in programs.items():
+            winners.add(shortest_configs(statistics(program))[0][:2])
+            if encode(program, workers=2) != encode(program):
+                print(f"Error: {name} encoded in parallel differs from encode()")
+                errors += 1
+    finally:
+        module.PIECE, module.PARALLEL_MIN, module.MIN_WORKERS = gates
+
+    for winner in (("normal", True), ("normal", False), ("short_alphabet", True)):
+        if winner not in winners:
+            print(f"Error: no program checked in parallel encodes best as {winner}")
+            errors += 1
+    return errors
+
+def check_stepping() -> int:
+    # Machine.run(k) executes exactly k instructions (fewer only if the
+    # program halts), and a run split at a snapshot prints what a single
+    # run does. An optimized countdown too long for k runs as its loop, so
+    # the split run may take more steps in all than a single one
+    errors = 0
+    for name, (program, input, expected) in CASES.items():
+        code = assemble(optimize(program))
+        machine = Machine(code, input)
+        machine.run()
+        total = machine.steps
+
+        for k in sorted({1, 7, total // 3, total // 2, total - 1, total}):
+            if not 1 <= k <= total:
+                continue
+            machine = Machine(code, input)
+            status = machine.run(k)
+            if not (status == STEPS and machine.steps == k or status == HALTED and machine.steps <= k):
+                print(f"Error: {name} run({k}) stopped with {status} after {machine.steps} steps")
+                errors += 1
+                continue
+
+            before = machine.take_output()      # the snapshot keeps only output not yet taken
+            snapshot = pickle.loads(pickle.dumps(machine.snapshot()))
+            resumed = Machine(code, input, snapshot)
+            status = resumed.run()
+            if status != HALTED or resumed.steps < machine.steps:
+                print(f"Error: {name} resumed after {k} steps stopped with {status} after {resumed.steps} steps")
+                errors += 1
+            elif before + resumed.take_output() != expected:
+                print(f"Error: {name} resumed after {k} steps printed the wrong output")
+                errors += 1
+    return errors
+
+def check_budgets() -> int:
+    # max_steps stops a straight-line run partway through, with or without other limits
+    errors = 0
+    long_run = [CADD(1), OUT()] * 5000     # one straight-line run of 10000 instructions
+    code = assemble(long_run)
+    limits = [{}, {"timeout": 100.0}, {"max_cell_bits": 1000}, {"timeout": 100.0, "max_cell_bits": 1000}]
+    for extra in limits:
+        for max_steps in (1, 4095, 4097, 5000):
+            machine = Machine(code)
+            status = machine.run(max_steps, **extra)
+            if status != STEPS or machine.steps != max_steps:
+                print(f"Error: run({max_steps}, {extra}) stopped with {status} after {machine.steps} steps")
+                errors += 1
+
+    # an optimized countdown (POWER's loop) runs in closed form, which must
+    # not outrun the limits either: 3 ** 10 ** 8 is a 158-million-bit cell
+    power = assemble(optimize(POWER))
+    for extra, expected in [({"max_steps": 1000}, STEPS), ({"timeout": 0.2}, TIMEOUT), ({"max_cell_bits": 20000}, CELL_SIZE)]:
+        machine = Machine(power, lines(3, 10 ** 8))
+        start = time.monotonic()
+        status = machine.run(**extra)
+        seconds = time.monotonic() - start
+        bits = max(abs(v).bit_length() for v in machine.tape)
+        if status != expected or seconds > 2 or bits > 2 * extra.get("max_cell_bits", bits):
+            print(f"Error: POWER countdown run({extra}) stopped with {status} after {seconds:.1f}s with a {bits}-bit cell")
+            errors += 1
+    return errors
+
+def check_nesting() -> int:
+    # programs nested deeper than Python's recursion limit still assemble and run
+    errors = 0
+    program = [OUT()]
+    for _ in range(1200):
+        program = [IFZ(program), CADD(0)]
+    for engine in ("vm", "native"):
+        try:
+            out = interpret(program, b"", engine)
+        except RecursionError:
+            out = "RecursionError"
+        if out != b"\x00":
+            print(f"Error: a program nested 1200 deep ({engine}) printed {out!r}")
+            errors += 1
+    return errors
+
+def check_batch() -> int:
+    # run_batch, in this process and in a pool, and the CLI give every job
+    # what a Machine would, budgets and errors included
+    errors = 0
+    jobs = [Job(encode(program), input) for program, input, _ in CASES.values()]
+    jobs += [Job(encode(POWER), lines(3, 2 * 10 ** 7), max_steps=1000),
+             Job(encode(POWER), lines(3, 2 * 10 ** 7), timeout=0.2),
+             Job(encode(POWER), lines(3, 2 * 10 ** 7), max_cell_bits=20000),
+             Job(encode([CDIV(0)])),
+             Job(0)]
+    expected = [(HALTED, output) for _, _, output in CASES.values()]
+    expected += [(STEPS, None), (TIMEOUT, None), (CELL_SIZE, None), (ERROR, b""), (ERROR, b"")]
+
+    for workers in (1, 2):
+        start = time.monotonic()
+        results = list(run_batch(jobs, workers))
+        if [r.index for r in results] != list(range(len(jobs))):
+            print(f"Error: run_batch(workers={workers}) returned results out of order")
+            errors += 1
+        for result, (status, output) in zip(results, expected):
+            if result.status != status or output is not None and result.output != output:
+                print(f"Error: run_batch(workers={workers}) job {result.index} stopped with {result.status}, expected {status}")
+                errors += 1
+        if time.monotonic() - start > 10:
+            print(f"Error: run_batch(workers={workers}) took {time.monotonic() - start:.1f}s")
+            errors += 1
+
+    lines_in = "".join(json.dumps({"program": str(job.program), "input": job.input.hex()}) + "\n" for job in jobs[:3])
+    cli = subprocess.run([sys.executable, "-m", "interpreter.batch", "--workers", "1", "--max-steps", "1000000"],
+                         input=lines_in, capture_output=True, text=True)
+    records = [json.loads(line) for line in cli.stdout.splitlines()]
+    if [(r["status"], bytes.fromhex(r["output"])) for r in records] != expected[:3]:
+        print(f"Error: python -m interpreter.batch printed {cli.stdout!r} {cli.stderr!r}")
+        errors += 1
+    return errors
+
+def check_search() -> int:
+    # search() finds the integer a plain scan of every integer does, serially
+    # and in a pool; the scan uses the same verdict, without any pruning
+    errors = 0
+    def scan(examples: list) -> int:
+        n = 1
+        while True:
+            try:
+                program = decode(n)
+            except ValueError:
+                program = None
+            if program is not None and search_check(program, examples, 10_000, 72) == PASSED:
+                return n
+            n += 1
+
+    for examples in ([(b"", b"\x01")], [(b"\x03", b"\x03")], [(b"\x00", b"\x00"), (b"\x02", b"")]):
+        expected = scan(examples)
+        for workers in (1, 2):
+            found = search(examples, workers=workers, chunk_size=1 << 12).program
+            if found != expected:
+                print(f"Error: search({examples}, workers={workers}) found {found}, a scan finds {expected}")
+                errors += 1
+    found = search([(b"", b"\x05")], workers=2).program   # checked by hand
+    if found != 680547:
+        print(f"Error: search([(b'', b'\\x05')]) found {found}, expected 680547")
+        errors += 1
+    return errors
+
+def check_async() -> int:
+    # aio sessions: IN waits for lines that arrive later on an asyncio
+    # stream (InputPending, then StreamInput.fill and the IN again), and a
+    # session that never halts yields every slice, so others still finish
+    errors = 0
+    async def fed(program, input: bytes) -> tuple:
+        reader = asyncio.StreamReader()
+        async def feed() -> None:
+            for i in range(0, len(input), 3):  # lines split across writes
+                await asyncio.sleep(0.001)
+                reader.feed_data(input[i:i + 3])
+            reader.feed_eof()
+        out = bytearray()
+        feeder = asyncio.create_task(feed())
+        status = await session(out.extend, assemble(program), reader)
+        await feeder
+        return status, bytes(out)
+
+    for name, (program, input, expected) in CASES.items():
+        status, out = asyncio.run(fed(program, input))
+        if status != HALTED or out != expected:
+            print(f"Error: {name} (streamed input) stopped with {status} and printed {out!r}, expected {expected!r}")
+            errors += 1
+
+    async def race() -> list:
+        finished = []
+        async def run(name: str, program: list, **budget) -> None:
+            await session(lambda chunk: None, assemble(program), b"", slice=1000, **budget)
+            finished.append(name)
+        spin = [CADD(1), LOOP([CADD(1)])]   # never halts
+        await asyncio.gather(run("spin", spin, max_steps=1_000_000), run("hello", HELLO_WORLD))
+        return finished
+    finished = asyncio.run(race())
+    if finished != ["hello", "spin"]:
+        print(f"Error: sessions finished in the order {finished}, a 1000-instruction slice should let hello finish first")
+        errors += 1
+    return errors
+
+def check_cache() -> int:
+    # ProgramCache evicts the least recently used entries past maxsize or
+    # max_bytes, counts what it does in stats, and with a directory stores
+    # entries under versioned names and rebuilds any it can't read
+    errors = 0
+    def expect(what: str, got, expected) -> None:
+        nonlocal errors
+        if got != expected:
+            print(f"Error: cache {what} is {got!r}, expected {expected!r}")
+            errors += 1
+
+    a, b, c = (encode(program) for program in (HELLO_WORLD, FACTORIAL, GCD))
+    cache = ProgramCache(maxsize=2)
+    cache.program(a); cache.program(b); cache.program(a); cache.program(c)   # b is least recent
+    expect("contents after evicting by count", sorted(cache.entries), sorted([(a, "program"), (c, "program")]))
+    expect("stats after evicting by count", cache.stats, CacheStats(hits=1, misses=3, evictions=1, entries=2,
+           bytes=sum(size for _, size in cache.entries.values())))
+    expect("program", cache.program(c), freeze(GCD))
+
+    size = footprint(c, "program", freeze(GCD))
+    cache = ProgramCache(max_bytes=size + 1)
+    cache.program(a); cache.program(c)
+    expect("contents after evicting by bytes", list(cache.entries), [(c, "program")])
+    expect("stats after evicting by bytes", (cache.stats.evictions, cache.stats.bytes), (1, size))
+
+    with tempfile.TemporaryDirectory() as directory:
+        ProgramCache(directory=directory).bytecode(c)
+        names = sorted(os.listdir(directory))
+        expect("files", [name.split(".", 1)[1] for name in names],
+               [f"{form}.v{DISK_VERSION}.pickle" for form in ("bytecode", "optimized", "program")])
+
+        cache = ProgramCache(directory=directory)
+        code = cache.bytecode(c)
+        expect("stats reading from disk", (cache.stats.disk_hits, cache.stats.misses), (1, 0))
+        expect("output from disk", b"".join(execute(code, CASES["GCD"][1])), CASES["GCD"][2])
+
+        with open(os.path.join(directory, names[0]), "wb") as f:
+            f.write(b"not a pickle")
+        cache = ProgramCache(directory=directory)
+        code = cache.bytecode(c)
+        expect("stats rebuilding an unreadable entry", (cache.stats.disk_hits, cache.stats.misses), (1, 1))
+        expect("output rebuilt", b"".join(execute(code, CASES["GCD"][1])), CASES["GCD"][2])
+        expect("rebuilt entry", ProgramCache(directory=directory).load(c, "bytecode") is not None, True)
+    return errors
+
+def check_input() -> int:
+    # IN reads the same integers from bytes, a BytesIO, a raw (unbuffered)
+    # file and an mmap of it, in every engine
+    errors = 0
+    samples = [lines(1071, 462), lines(-1, 0, 2 ** 70, -129) + b"\n", b"\n\n\x05\n", b"\xff"]
+    with tempfile.TemporaryDirectory() as directory:
+        for data in samples:
+            path = os.path.join(directory, "input")
+            with open(path, "wb") as f:
+                f.write(data)
+            reader = InputReader(data)
+            expected = [reader() for _ in range(8)]     # past the end: 0
+            with open(path, "rb", buffering=0) as raw, open(path, "rb") as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for kind, input in [("BytesIO", io.BytesIO(data)), ("FileIO", raw), ("mmap", mapped)]:
+                    reader = InputReader(input)
+                    got = [reader() for _ in range(8)]
+                    if got != expected:
+                        print(f"Error: IN from {kind} of {data!r} read {got}, expected {expected}")
+                        errors += 1
+
+        program, input, expected = CASES["GCD"]
+        with open(path, "wb") as f:
+            f.write(input)
+        for engine in ("tree", "vm", "native"):
+            with open(path, "rb", buffering=0) as raw, open(path, "rb") as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for kind, source in [("BytesIO", io.BytesIO(input)), ("FileIO", raw), ("mmap", mapped)]:
+                    out = interpret(program, source, engine)
+                    if out != expected:
+                        print(f"Error: GCD ({engine}) with input from {kind} printed {out!r}, expected {expected!r}")
+                        errors += 1
+    return errors
+
+def run_checks() -> int:
+    checks = [check_engines, check_sharing, check_encoding, check_parallel_encoding, check_stepping,
+              check_budgets, check_nesting, check_batch, check_search,
+              check_async, check_cache, check_input]
+    errors = sum(check() for check in checks)
+    print("-" * 80)
+    print(f"{errors} error(s)")
+    return errors
+
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["check"]:
+        sys.exit(1 if run_checks() else 0)
+
     # test_and_compute_compactness()
 
     TEST = HELLO_WORLD # change